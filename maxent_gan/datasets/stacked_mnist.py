@@ -1,39 +1,109 @@
+import os
 from pathlib import Path
+from typing import Optional
 
 import numpy as np
 import torch
-from skimage.transform import rescale
+from torch.nn import functional as F
 from torchvision import datasets
 
-from maxent_gan.utils.general_utils import DATA_DIR
+from maxent_gan.utils.general_utils import DATA_DIR, load_uint8_cache
 
 
 ORIG_IMG_SIZE = 28
 
 
-def stack_mnist(
-    num_training_sample: int = 60000, image_size: int = 64
-) -> torch.FloatTensor:
+def resize_digits(
+    digits: np.ndarray, image_size: int, batch_size: int = 10000
+) -> np.ndarray:
+    """
+    Bilinear resize of uint8 images [N, H, W] to image_size, batch by batch
+
+    Returns:
+        uint8 array of shape [N, image_size, image_size]
+    """
+    resized = np.empty((len(digits), image_size, image_size), dtype=np.uint8)
+    for start in range(0, len(digits), batch_size):
+        batch = torch.from_numpy(digits[start : start + batch_size]).float()
+        batch = F.interpolate(
+            batch[:, None], size=image_size, mode="bilinear", align_corners=False
+        )[:, 0]
+        resized[start : start + batch_size] = batch.round().clamp(0, 255).byte()
+    return resized
+
+
+def generate_stacked_mnist(
+    num_training_sample: int = 60000,
+    image_size: int = 64,
+    seed: Optional[int] = None,
+) -> np.ndarray:
     # Load MNIST images... 60K in train and 10K in test
     datasets.MNIST(root=DATA_DIR, download=True, transform=None)
 
     loaded = np.fromfile(
         file=Path(DATA_DIR, "MNIST/raw/train-images-idx3-ubyte"), dtype=np.uint8
     )
-    trX = loaded[16:].reshape((60000, ORIG_IMG_SIZE, ORIG_IMG_SIZE, 1)).astype(np.float)
-
-    # Form training and test using MNIST images
-    ids = np.random.randint(0, trX.shape[0], size=(num_training_sample, 3))
-    X_training = np.zeros(shape=(ids.shape[0], image_size, image_size, ids.shape[1]))
-
-    for i in range(ids.shape[0]):
-        for j in range(ids.shape[1]):
-            xij = trX[ids[i, j], :, :, 0]
-            xij = rescale(xij, (image_size / ORIG_IMG_SIZE, image_size / ORIG_IMG_SIZE))
-            X_training[i, :, :, j] = xij
-
-        # if i % 10000 == 0:
-        #     print('i: {}/{}'.format(i, ids.shape[0]))
-    X_training = X_training / 255.0
-    X_training = torch.FloatTensor(X_training).permute(0, 3, 2, 1)
-    return X_training
+    digits = loaded[16:].reshape((60000, ORIG_IMG_SIZE, ORIG_IMG_SIZE))
+    digits = resize_digits(digits, image_size)
+
+    # each channel of a sample is a random digit
+    rng = np.random.RandomState(seed) if seed is not None else np.random
+    ids = rng.randint(0, digits.shape[0], size=(num_training_sample, 3))
+    # [N, C, W, H] as produced before, keeps orientation of the digits
+    return digits[ids].transpose(0, 1, 3, 2)
+
+
+def default_seed(num_training_sample: int, image_size: int) -> int:
+    """
+    Seed of digits' choice used if none is given, it is drawn from global
+    numpy state on the first call and recorded, so cached images are reused
+    """
+    path = Path(
+        DATA_DIR,
+        "stacked_mnist",
+        f"stacked_mnist_{num_training_sample}_{image_size}.seed",
+    )
+    if path.exists():
+        return int(path.read_text())
+    seed = int(np.random.randint(2 ** 31))
+    path.parent.mkdir(exist_ok=True, parents=True)
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    tmp_path.write_text(str(seed))
+    os.replace(tmp_path, path)
+    return seed
+
+
+def stack_mnist_uint8(
+    num_training_sample: int = 60000,
+    image_size: int = 64,
+    seed: Optional[int] = None,
+) -> np.ndarray:
+    """
+    Stacked MNIST images as uint8 array of shape [N, 3, image_size, image_size],
+    images are cached on disk and memory-mapped
+
+    Args:
+        num_training_sample - number of samples
+        image_size - spatial size of samples
+        seed - seed of digits' choice, if None, seed recorded by default_seed
+            is used
+    """
+    if seed is None:
+        seed = default_seed(num_training_sample, image_size)
+    return load_uint8_cache(
+        Path(
+            DATA_DIR,
+            "stacked_mnist",
+            f"stacked_mnist_{num_training_sample}_{image_size}_{seed}.npy",
+        ),
+        lambda: generate_stacked_mnist(num_training_sample, image_size, seed),
+    )
+
+
+def stack_mnist(
+    num_training_sample: int = 60000,
+    image_size: int = 64,
+    seed: Optional[int] = None,
+) -> torch.FloatTensor:
+    data = stack_mnist_uint8(num_training_sample, image_size, seed)
+    return torch.from_numpy(np.ascontiguousarray(data)).float() / 255.0
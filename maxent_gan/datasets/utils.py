@@ -1,18 +1,31 @@
 import zipfile
 from pathlib import Path
-from typing import Any, Dict, Optional, Tuple, Union
+from typing import Any, Dict, Optional, Sequence, Tuple, Union
 
 import gdown
 import numpy as np
 import torch
 import torchvision
 from PIL import Image
-from torch.utils.data import ConcatDataset, Dataset, TensorDataset
+from torch.nn import functional as F
+from torch.utils.data import (
+    BatchSampler,
+    ConcatDataset,
+    DataLoader,
+    Dataset,
+    RandomSampler,
+    SequentialSampler,
+    TensorDataset,
+)
 from torchvision import transforms as T
 
-from maxent_gan.utils.general_utils import DATA_DIR, IgnoreLabelDataset
+from maxent_gan.utils.general_utils import (
+    DATA_DIR,
+    IgnoreLabelDataset,
+    load_uint8_cache,
+)
 
-from .stacked_mnist import stack_mnist
+from .stacked_mnist import stack_mnist_uint8
 from .synthetic import (
     prepare_2d_gaussian_grid_data,
     prepare_2d_ring_data,
@@ -32,10 +45,92 @@ class TrainGANDataset(Dataset):
     def __len__(self):
         return self.length
 
-    def __getitem__(self, idx: int):
+    @property
+    def vectorised(self) -> bool:
+        return getattr(self.dataset, "vectorised", False)
+
+    def __getitem__(self, idx: Union[int, Sequence[int]]):
+        if not isinstance(idx, int):
+            idx = np.asarray(idx)
         return self.dataset[idx % len(self.dataset)]
 
 
+class UInt8ImageDataset(Dataset):
+    """
+    Images stored as one contiguous uint8 array (memory-mapped if loaded from
+    cache). Indexing by a sequence of indices returns a whole batch of
+    normalised float images computed with vectorised ops.
+
+    Args:
+        data - uint8 array of shape [N, C, H, W]
+        mean, std - normalisation parameters
+        img_size - output spatial size, images are not resized if it matches
+    """
+
+    vectorised = True
+
+    def __init__(
+        self,
+        data: np.ndarray,
+        mean: Tuple[float, ...],
+        std: Tuple[float, ...],
+        img_size: Optional[int] = None,
+    ):
+        self.data = data
+        self.mean = torch.as_tensor(mean, dtype=torch.float)[:, None, None]
+        self.std = torch.as_tensor(std, dtype=torch.float)[:, None, None]
+        self.img_size = img_size if img_size != data.shape[-1] else None
+
+    def __len__(self):
+        return len(self.data)
+
+    def __getitem__(self, idx: Union[int, Sequence[int]]) -> torch.FloatTensor:
+        if isinstance(idx, torch.Tensor):
+            idx = idx.numpy()
+        batch = torch.from_numpy(np.ascontiguousarray(self.data[idx]))
+        batch = batch.float().div_(255.0)
+        single = batch.ndim == 3
+        if single:
+            batch = batch[None]
+        if self.img_size is not None:
+            batch = F.interpolate(
+                batch, size=self.img_size, mode="bilinear", align_corners=False
+            )
+        batch = (batch - self.mean) / self.std
+        return batch[0] if single else batch
+
+
+def get_dataloader(
+    dataset: Dataset,
+    batch_size: int,
+    shuffle: bool = False,
+    generator: Optional[torch.Generator] = None,
+    **kwargs,
+) -> DataLoader:
+    """
+    DataLoader for dataset, batches of vectorised datasets (UInt8ImageDataset)
+    are fetched by one indexing instead of per-item calls and collation
+    """
+    if not getattr(dataset, "vectorised", False):
+        return DataLoader(
+            dataset,
+            batch_size=batch_size,
+            shuffle=shuffle,
+            generator=generator,
+            **kwargs,
+        )
+    if shuffle:
+        sampler = RandomSampler(dataset, generator=generator)
+    else:
+        sampler = SequentialSampler(dataset)
+    return DataLoader(
+        dataset,
+        sampler=BatchSampler(sampler, batch_size, drop_last=False),
+        batch_size=None,
+        **kwargs,
+    )
+
+
 def download_celeba():
     data_root = Path(DATA_DIR, "celeba")
     data_root.mkdir(exist_ok=True)
@@ -110,8 +205,31 @@ def get_cifar_dataset(
     std: Tuple[float, float, float] = (0.5, 0.5, 0.5),
     img_size: int = 32,
     split="traintest",
+    in_memory: bool = False,
     **kwargs,
 ) -> Dict[str, Dataset]:
+    """
+    Args:
+        in_memory - whether to decode the split once into a uint8 array
+            cached on disk and memory-mapped (see UInt8ImageDataset)
+    """
+    if in_memory:
+
+        def build() -> np.ndarray:
+            data = [
+                torchvision.datasets.CIFAR10(
+                    Path(DATA_DIR, "cifar10").as_posix(), download=True, train=train
+                ).data
+                for train in [True, False]
+                if ("train" if train else "test") in split
+            ]
+            return np.concatenate(data).transpose(0, 3, 1, 2)
+
+        data = load_uint8_cache(
+            Path(DATA_DIR, "cifar10", f"cifar10_{split}_uint8.npy"), build
+        )
+        return {"dataset": UInt8ImageDataset(data, mean, std, img_size)}
+
     datasets = []
     if "train" in split:
         datasets.append(
@@ -191,8 +309,23 @@ def get_stacked_mnist_dataset(
     sample_size: int = 60000,
     mean: Tuple[float, float, float] = (0.5, 0.5, 0.5),
     std: Tuple[float, float, float] = (0.5, 0.5, 0.5),
+    image_size: int = 64,
+    seed: Optional[int] = None,
+    in_memory: bool = False,
 ) -> Dict[str, Dataset]:
-    tensor = stack_mnist(sample_size)
+    """
+    Args:
+        image_size - spatial size of images
+        seed - seed of digits' choice (recorded on the first run if None),
+            generated images are cached on disk
+        in_memory - whether to keep images as a memory-mapped uint8 array
+            (see UInt8ImageDataset)
+    """
+    data = stack_mnist_uint8(sample_size, image_size, seed)
+    if in_memory:
+        return {"dataset": UInt8ImageDataset(data, mean, std)}
+
+    tensor = torch.from_numpy(np.ascontiguousarray(data)).float() / 255.0
     mean = torch.as_tensor(mean)
     std = torch.as_tensor(std)
     transform = T.Normalize(mean, std)
@@ -1,5 +1,5 @@
 from abc import ABC, abstractmethod
-from typing import Callable, Dict, Optional
+from typing import Callable, Dict, List, Optional, Tuple
 
 import torch
 
@@ -14,6 +14,53 @@ class Distribution(ABC):
         """Computes log probability of input z"""
         raise NotImplementedError
 
+    def log_prob_and_grad(
+        self, z: torch.FloatTensor, **kwargs
+    ) -> Tuple[torch.FloatTensor, torch.FloatTensor]:
+        """
+        Computes log probability of input z and its gradient w.r.t. z chunk by
+        chunk, graph of each chunk is freed right after its backward pass,
+        so peak memory is bounded by the chunk size
+
+        Args:
+            z - points of shape [..., dim]
+            batch_size - chunk size (default is self.batch_size, if any)
+            kwargs - passed to log_prob, tensors with one row per point
+                (e.g. x, data_batch) are split along with z
+
+        Returns:
+            detached log probabilities of shape [...], gradients of z's shape
+        """
+        init_shape = z.shape
+        z = z.detach().reshape(-1, init_shape[-1])
+        batch_size = kwargs.pop("batch_size", None)
+        batch_size = batch_size or getattr(self, "batch_size", None) or len(z)
+        log_prob = None
+        grad = torch.empty_like(z)
+        for start in range(0, len(z), batch_size):
+            chunk = z[start : start + batch_size].requires_grad_()
+            chunk_kwargs = {
+                key: value[start : start + batch_size]
+                if isinstance(value, torch.Tensor) and value.shape[:1] == z.shape[:1]
+                else value
+                for key, value in kwargs.items()
+            }
+            chunk_log_prob = self.log_prob(chunk, **chunk_kwargs)
+            grad[start : start + batch_size] = torch.autograd.grad(
+                chunk_log_prob.sum(), chunk
+            )[0]
+            if log_prob is None:
+                log_prob = z.new_empty(len(z), device=chunk_log_prob.device)
+            log_prob[start : start + batch_size] = chunk_log_prob.detach()
+        return log_prob.reshape(init_shape[:-1]), grad.reshape(init_shape)
+
+    def accept(self, mask: Optional[torch.BoolTensor] = None):
+        """
+        Called by MCMC kernels after accept / reject, mask marks chains
+        moved to the last evaluated points (all chains if None)
+        """
+        pass
+
 
 class DistributionRegistry:
     registry: Dict = {}
@@ -65,17 +112,17 @@ class DiscriminatorTarget(Distribution):
         init_shape = z.shape
         z = z.reshape(-1, init_shape[-1])
         batch_size = kwargs.get("batch_size", self.batch_size or len(z))
-        log_prob = torch.empty((0,), device=self.device)
-        for chunk_id, chunk in enumerate(torch.split(z, batch_size)):
+        # chunks are written into preallocated output
+        log_prob = torch.empty((len(z),), device=self.device)
+        for start in range(0, len(z), batch_size):
+            chunk = z[start : start + batch_size]
             if "x" in kwargs:
-                x = kwargs["x"][chunk_id * batch_size : (chunk_id + 1) * batch_size].to(
-                    self.device
-                )
+                x = kwargs["x"][start : start + batch_size].to(self.device)
             else:
                 x = self.gan.gen(chunk.to(self.device))
             dgz = self.gan.dis(x).squeeze()
             logp_z = self.proposal.log_prob(chunk)
-            log_prob = torch.cat([log_prob, (logp_z + dgz) / 1.0])
+            log_prob[start : start + batch_size] = (logp_z + dgz) / 1.0
         return log_prob.reshape(init_shape[:-1])
 
     def project(self, z):
@@ -124,6 +171,19 @@ class CondTarget(Distribution):
 
         return log_prob
 
+    def log_prob_and_grad(
+        self,
+        z: torch.FloatTensor,
+        data_batch: Optional[torch.FloatTensor] = None,
+        **kwargs,
+    ) -> Tuple[torch.FloatTensor, torch.FloatTensor]:
+        """
+        Chunked log probability and its gradient (see Distribution),
+        stored data batch is split along with z
+        """
+        data_batch = data_batch if data_batch is not None else self.data_batch
+        return super().log_prob_and_grad(z, data_batch=data_batch, **kwargs)
+
     def project(self, z):
         return self.proposal.project(z)
 
@@ -145,6 +205,7 @@ class MaxEntTarget(Distribution):
         self.batch_size = batch_size
         self.radnic_logps = []
         self.ref_logps = []
+        self.last_feature_out: Optional[List[torch.FloatTensor]] = None
 
     def log_prob(
         self,
@@ -155,26 +216,119 @@ class MaxEntTarget(Distribution):
         init_shape = z.shape
         z = z.reshape(-1, init_shape[-1])
         batch_size = kwargs.get("batch_size", self.batch_size or len(z))
-        log_prob = torch.empty((0,), device=self.device)
-        feature_out = [torch.empty((0,))] * self.feature.n_features
-
-        for chunk in torch.split(z, batch_size):
-            chunk = chunk.to(self.device)
-            x = self.gen(chunk)
-            f = self.feature(x=x, z=chunk)
-            radnic_logp = self.feature.log_prob(f)
-            ref_logp = self.ref_dist.log_prob(chunk, x=x, data_batch=data_batch)
-            if not isinstance(radnic_logp, torch.Tensor):
-                radnic_logp = torch.zeros_like(ref_logp, device=ref_logp.device)
-            log_prob = torch.cat([log_prob, radnic_logp + ref_logp])
-            feature_out = [
-                torch.cat([x, y.detach().cpu()]) for x, y in zip(feature_out, f)
-            ]
-        self.feature.output_history.append(feature_out)
+        # chunks are written into preallocated outputs
+        log_prob = torch.empty((len(z),), device=self.device)
+        feature_out = None
+
+        for start in range(0, len(z), batch_size):
+            chunk = z[start : start + batch_size]
+            log_prob[start : start + batch_size], f = self.chunk_log_prob(
+                chunk, self.data_chunk(data_batch, len(z), start, batch_size)
+            )
+            feature_out = self.write_features(feature_out, f, start, len(z))
+        self.record_features(feature_out, init_shape)
         # self.radnic_logps.append(radnic_logp.detach())
         # self.ref_logps.append(ref_logp.detach())
         return log_prob.reshape(init_shape[:-1])
 
+    def log_prob_and_grad(
+        self,
+        z: torch.FloatTensor,
+        data_batch: Optional[torch.FloatTensor] = None,
+        **kwargs,
+    ) -> Tuple[torch.FloatTensor, torch.FloatTensor]:
+        """
+        Chunked log probability and its gradient (see Distribution),
+        features are recorded once for the whole input as in log_prob
+        """
+        init_shape = z.shape
+        z = z.detach().reshape(-1, init_shape[-1])
+        batch_size = kwargs.get("batch_size", self.batch_size or len(z))
+        log_prob = torch.empty((len(z),), device=self.device)
+        grad = torch.empty(z.shape, device=self.device)
+        feature_out = None
+
+        for start in range(0, len(z), batch_size):
+            chunk = z[start : start + batch_size].to(self.device).requires_grad_()
+            chunk_log_prob, f = self.chunk_log_prob(
+                chunk, self.data_chunk(data_batch, len(z), start, batch_size)
+            )
+            grad[start : start + batch_size] = torch.autograd.grad(
+                chunk_log_prob.sum(), chunk
+            )[0]
+            log_prob[start : start + batch_size] = chunk_log_prob.detach()
+            feature_out = self.write_features(feature_out, f, start, len(z))
+        self.record_features(feature_out, init_shape)
+        return log_prob.reshape(init_shape[:-1]), grad.reshape(init_shape)
+
+    def data_chunk(
+        self,
+        data_batch: Optional[torch.FloatTensor],
+        n: int,
+        start: int,
+        batch_size: int,
+    ) -> Optional[torch.FloatTensor]:
+        """
+        Rows of data batch (given one or the one stored in ref_dist) paired
+        with chunk of n points starting at start, data batch without a row
+        per point is returned as is
+        """
+        if data_batch is None:
+            data_batch = getattr(self.ref_dist, "data_batch", None)
+        if isinstance(data_batch, torch.Tensor) and len(data_batch) == n:
+            return data_batch[start : start + batch_size]
+        return data_batch
+
+    def chunk_log_prob(
+        self, chunk: torch.FloatTensor, data_batch: Optional[torch.FloatTensor]
+    ) -> Tuple[torch.FloatTensor, List[torch.FloatTensor]]:
+        chunk = chunk.to(self.device)
+        x = self.gen(chunk)
+        f = self.feature(x=x, z=chunk)
+        radnic_logp = self.feature.log_prob(f)
+        ref_logp = self.ref_dist.log_prob(chunk, x=x, data_batch=data_batch)
+        if not isinstance(radnic_logp, torch.Tensor):
+            radnic_logp = torch.zeros_like(ref_logp, device=ref_logp.device)
+        return radnic_logp + ref_logp, f
+
+    @staticmethod
+    def write_features(
+        feature_out: Optional[List[torch.FloatTensor]],
+        f: List[torch.FloatTensor],
+        start: int,
+        n: int,
+    ) -> List[torch.FloatTensor]:
+        """
+        Writes features of chunk starting at start into device buffers
+        for n points, allocated on the first chunk
+        """
+        if feature_out is None:
+            feature_out = [
+                torch.empty((n, *out.shape[1:]), dtype=out.dtype, device=out.device)
+                for out in f
+            ]
+        for buffer, out in zip(feature_out, f):
+            buffer[start : start + len(out)] = out.detach()
+        return feature_out
+
+    def record_features(
+        self, feature_out: List[torch.FloatTensor], init_shape: torch.Size
+    ):
+        # features stay on the device, only the last call is kept
+        self.feature.record_output(feature_out)
+        # features of the last batch, used by Rao-Blackwellised estimators
+        self.last_feature_out = [
+            out.reshape(*init_shape[:-1], -1) for out in feature_out
+        ]
+
+    def accept(self, mask: Optional[torch.BoolTensor] = None):
+        self.feature.accept_output(mask)
+
+    @property
+    def chain_feature_out(self) -> Optional[List[torch.FloatTensor]]:
+        """Features of current chain states, kept aligned by accept"""
+        return self.feature.chain_output
+
     def project(self, z):
         return self.proposal.project(z)
 
@@ -1,3 +1,4 @@
 # flake8: noqa
+from .embedding import EmbeddingRegistry
 from .feature import BaseFeature, Feature, FeatureRegistry
 from .utils import create_feature
@@ -0,0 +1,157 @@
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Callable, Dict, Hashable, Optional, Tuple, Union
+
+import torch
+import torchvision
+from torchvision import transforms
+
+from maxent_gan.models.base import CachedModel
+from maxent_gan.utils.hooks import Holder, holder_hook
+
+
+class Embedding(object):
+    """
+    Shared handle of a pretrained backbone, returns activations of its avgpool
+
+    Embeddings of recent input batches are memoised (graph included), so
+    several features evaluated on the same batch run one forward pass.
+
+    Args:
+        model - backbone with avgpool layer
+        max_size - maximal number of memoised batches
+    """
+
+    def __init__(self, model: torch.nn.Module, max_size: int = 2):
+        self.model = model
+        self.max_size = max_size
+        self.activation = Holder()
+        module = model.module if isinstance(model, torch.nn.DataParallel) else model
+        module.avgpool.register_forward_hook(holder_hook(self.activation))
+        self.cache: OrderedDict = OrderedDict()
+
+    def __call__(
+        self, x: torch.FloatTensor, preprocess: Optional[Callable] = None
+    ) -> torch.FloatTensor:
+        """
+        Args:
+            x - input batch
+            preprocess - transform applied to batch before the backbone,
+                batches are memoised per (input, preprocess) pair
+
+        Returns:
+            embeddings of shape [batch_size, dim]
+        """
+        key = (CachedModel.tensor_key(x), preprocess)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key][1]
+
+        self.model(preprocess(x) if preprocess else x)
+        out = torch.cat([_.to(x.device) for _ in self.activation], 0).view(len(x), -1)
+        self.activation.reset()
+        # input is kept alive, so its storage pointer cannot be reused
+        self.cache[key] = (x, out)
+        if len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+        return out
+
+    def clear(self):
+        self.cache.clear()
+
+
+class EmbeddingRegistry:
+    """
+    Process-wide registry of backbones, each backbone is loaded once
+    per device and shared between features
+    """
+
+    registry: Dict = {}
+    handles: Dict[Tuple, Embedding] = {}
+
+    @classmethod
+    def register(cls, name: Optional[str] = None) -> Callable:
+        def inner_wrapper(wrapped_fn: Callable) -> Callable:
+            if name is None:
+                name_ = wrapped_fn.__name__
+            else:
+                name_ = name
+            cls.registry[name_] = wrapped_fn
+            return wrapped_fn
+
+        return inner_wrapper
+
+    @classmethod
+    def get(
+        cls,
+        name: str,
+        device: Union[str, int, torch.device] = 0,
+        dp: bool = False,
+    ) -> Embedding:
+        if name not in cls.registry:
+            raise ValueError(f"Embedding model {name} is not available")
+        key = (name, torch.device(device), dp)
+        if key not in cls.handles:
+            model = cls.registry[name]().to(device)
+            if dp:
+                model = torch.nn.DataParallel(model)
+            model.eval()
+            cls.handles[key] = Embedding(model)
+        return cls.handles[key]
+
+    @classmethod
+    def clear_cache(cls):
+        """Drops memoised embeddings, called after each sampling step"""
+        for handle in cls.handles.values():
+            handle.clear()
+
+
+@lru_cache(maxsize=None)
+def get_preprocess(
+    inverse_transform: Optional[Hashable], normalize_first: bool = False
+) -> Callable:
+    """
+    Returns preprocessing of generated images, the same object for the same
+    arguments, so that features sharing it share memoised embeddings
+
+    Args:
+        inverse_transform - transform from generator outputs to images
+        normalize_first - whether to normalize before inverse_transform
+
+    Returns:
+        preprocessing callable
+    """
+    normalize = transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))
+    inverse_transform = inverse_transform or (lambda x: x)
+
+    def preprocess(x: torch.FloatTensor) -> torch.FloatTensor:
+        if normalize_first:
+            return inverse_transform(normalize(x))
+        return normalize(inverse_transform(x))
+
+    return preprocess
+
+
+@EmbeddingRegistry.register("resnet18")
+def resnet18() -> torch.nn.Module:
+    return torchvision.models.resnet18(pretrained=True)
+
+
+@EmbeddingRegistry.register("resnet34")
+def resnet34() -> torch.nn.Module:
+    return torchvision.models.resnet34(pretrained=True)
+
+
+@EmbeddingRegistry.register("resnet50")
+def resnet50() -> torch.nn.Module:
+    return torchvision.models.resnet50(pretrained=True)
+
+
+@EmbeddingRegistry.register("resnet101")
+def resnet101() -> torch.nn.Module:
+    return torchvision.models.resnet101(pretrained=True)
+
+
+@EmbeddingRegistry.register("efficientnet_b3")
+def efficientnet_b3() -> torch.nn.Module:
+    return torchvision.models.efficientnet_b3(pretrained=True)
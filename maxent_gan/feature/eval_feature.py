@@ -7,10 +7,9 @@ from typing import Optional
 import numpy as np
 import ruamel.yaml as yaml
 import torch
-from torch.utils.data import DataLoader
 from tqdm import tqdm
 
-from maxent_gan.datasets.utils import get_dataset
+from maxent_gan.datasets.utils import get_dataloader, get_dataset
 from maxent_gan.utils.general_utils import DotConfig  # isort:block
 from maxent_gan.utils.general_utils import random_seed
 
@@ -38,7 +37,7 @@ def parse_arguments():
 def evaluate(
     feature, dataset, batch_size: int, device, save_path: Optional[Path] = None
 ):
-    dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=True)
+    dataloader = get_dataloader(dataset, batch_size=batch_size, shuffle=True)
     stats = defaultdict(lambda: 0.0)
     n = 0
     for batch in tqdm(dataloader):
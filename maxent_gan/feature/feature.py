@@ -4,14 +4,16 @@ from typing import Any, Callable, Dict, List, Optional, Union
 
 import numpy as np
 import torch
+import torch.distributed as dist
 import torchvision
 from pytorch_fid.inception import InceptionV3
 from torch.nn.functional import adaptive_avg_pool2d
 from torch.optim import SGD, Adam
 from torchvision import transforms
 
+from maxent_gan.feature.embedding import EmbeddingRegistry, get_preprocess
 from maxent_gan.utils.cmd import CMD
-from maxent_gan.utils.hooks import Holder, holder_hook, penult_layer_activation
+from maxent_gan.utils.hooks import penult_layer_activation
 from maxent_gan.utils.kernels import KernelRegistry
 
 
@@ -21,9 +23,9 @@ class AvgHolder(object):
     def __init__(self, init_val: Any = 0):
         self.val = init_val
 
-    def upd(self, new_val: Any):
-        self.cnt += 1
-        alpha = 1.0 / self.cnt
+    def upd(self, new_val: Any, weight: float = 1.0):
+        self.cnt += weight
+        alpha = weight / self.cnt
         if isinstance(self.val, list):
             for i in range(len(self.val)):
                 self.val[i] = self.val[i] * (1.0 - alpha) + new_val[i] * alpha
@@ -37,6 +39,21 @@ class AvgHolder(object):
             self.val = 0
         self.cnt = 0
 
+    def all_reduce(self, n_items: int):
+        """
+        Replaces value with the average over all processes of the default
+        process group, weighted by number of items averaged in each process
+        """
+        values = self.val if isinstance(self.val, list) else [self.val]
+        device = next((v.device for v in values if isinstance(v, torch.Tensor)), None)
+        total = torch.tensor(float(n_items), device=device)
+        dist.all_reduce(total)
+        for i, value in enumerate(values):
+            value = torch.as_tensor(value, dtype=torch.float, device=device) * n_items
+            dist.all_reduce(value)
+            values[i] = value / total
+        self.val = values if isinstance(self.val, list) else values[0]
+
     @property
     def data(self) -> Any:
         return self.val
@@ -72,7 +89,9 @@ class BaseFeature(ABC):
         self.init_weight()
         self.init_optimizer()
 
-        self.output_history = []
+        # outputs of the last evaluated points and of the current chain states
+        self.last_output: Optional[List[torch.FloatTensor]] = None
+        self.chain_output: Optional[List[torch.FloatTensor]] = None
 
     @classmethod
     def __name__(cls):
@@ -123,7 +142,26 @@ class BaseFeature(ABC):
         self.avg_feature.reset()
         self.init_weight()
         self.init_optimizer()
-        self.output_history = []
+        self.reset_output()
+
+    def state_dict(self) -> Dict[str, Any]:
+        return dict(
+            weight=[w.detach().clone() for w in self.weight],
+            opt=self.opt.state_dict() if self.opt else None,
+            avg_weight=(self.avg_weight.val, self.avg_weight.cnt),
+            avg_feature=(self.avg_feature.val, self.avg_feature.cnt),
+            chain_output=self.chain_output,
+        )
+
+    def load_state_dict(self, state: Dict[str, Any]):
+        with torch.no_grad():
+            for w, saved_w in zip(self.weight, state["weight"]):
+                w.copy_(saved_w)
+        if self.opt:
+            self.opt.load_state_dict(state["opt"])
+        self.avg_weight.val, self.avg_weight.cnt = state["avg_weight"]
+        self.avg_feature.val, self.avg_feature.cnt = state["avg_feature"]
+        self.chain_output = state.get("chain_output")
 
     # @staticmethod
     # def average_feature(feature_method: Callable) -> Callable:
@@ -135,25 +173,86 @@ class BaseFeature(ABC):
 
     #     return with_avg
 
-    def average_feature(self, masks: List[torch.BoolTensor]):
-        if isinstance(masks, torch.Tensor) and masks.ndim == 1:
-            masks = [masks]
-        for step_id, mask in enumerate(masks[::-1], start=1):
-            out = self.output_history[step_id]
-            for i in range(len(out)):
-                out[i][mask] = self.output_history[step_id - 1][i][mask]
-            self.avg_feature.upd([x.mean(0) for x in out])
-        self.output_history = self.output_history[:-1]
-
-    @staticmethod
-    def collect_feature(feature_method: Callable) -> Callable:
-        # @wraps
-        def wrapped(self, *args, **kwargs):
-            out = feature_method(self, *args, **kwargs)
-            self.output_history.append([x.detach().cpu() for x in out])
-            return out
-
-        return wrapped
+    def record_output(self, out: List[torch.FloatTensor]):
+        """
+        Keeps outputs of the last evaluated batch of points (on their device),
+        called by the target once per batch with outputs of all its chunks
+
+        Args:
+            out - feature outputs of shape [n_points, ...]
+        """
+        self.last_output = [x.detach() for x in out]
+        if self.chain_output is None:
+            self.chain_output = self.last_output
+
+    def reset_output(self):
+        self.last_output = None
+        self.chain_output = None
+
+    def accept_output(self, mask: Optional[torch.BoolTensor] = None):
+        """
+        Moves outputs of accepted chains to the last evaluated points,
+        called by MCMC kernels after each accept / reject
+
+        Args:
+            mask - accept mask of shape [n_chains], or one-hot mask of selected
+                particles of shape [n_chains, n_particles], particles of each
+                chain are consecutive in the last evaluated points,
+                all chains are moved if None
+        """
+        if not self.last_output:
+            return
+        out = self.last_output
+        if mask is None:
+            self.chain_output = out
+            return
+
+        mask = mask.to(out[0].device, non_blocking=True)
+        n_chains = len(mask)
+        prev = self.chain_output
+        if mask.ndim == 2:
+            n_particles = mask.shape[1]
+            chain_output = []
+            for i, x in enumerate(out):
+                if len(x) % n_chains != 0:
+                    raise ValueError(
+                        f"{len(x)} evaluated points do not match {n_chains} chains"
+                    )
+                x = x.reshape(n_chains, -1, *x.shape[1:])
+                if x.shape[1] == n_particles - 1:
+                    # current points were not evaluated, they are particles 0
+                    if prev is None or len(prev[i]) != n_chains:
+                        raise ValueError("Outputs of current points are unknown")
+                    x = torch.cat([prev[i][:, None], x], 1)
+                elif x.shape[1] != n_particles:
+                    raise ValueError(
+                        f"{x.shape[1]} points per chain, expected {n_particles}"
+                    )
+                select = mask.reshape(*mask.shape, *([1] * (x.ndim - 2)))
+                chain_output.append((x * select.to(x.dtype)).sum(1))
+            self.chain_output = chain_output
+        else:
+            if len(out[0]) != n_chains or prev is None or len(prev[0]) != n_chains:
+                raise ValueError(
+                    f"Accept mask of {n_chains} chains does not match "
+                    f"{len(out[0])} evaluated points"
+                )
+            self.chain_output = [
+                torch.where(mask.reshape(-1, *([1] * (x.ndim - 1))), x, prev_x)
+                for x, prev_x in zip(out, prev)
+            ]
+
+    def average_feature(self):
+        """
+        Updates the running mean of features over current chain states,
+        weighted by number of chains
+        """
+        if not self.chain_output:
+            return
+        self.avg_feature.upd(
+            [x.float().mean(0) for x in self.chain_output],
+            weight=len(self.chain_output[0]),
+        )
 
     @staticmethod
     def get_useful_info(
@@ -269,7 +368,6 @@ class Feature(BaseFeature):
             )
         return result
 
-    @BaseFeature.collect_feature
     def __call__(
         self, x: torch.FloatTensor, z: Optional[torch.FloatTensor] = None
     ) -> List[torch.FloatTensor]:
@@ -334,7 +432,6 @@ class Feature(BaseFeature):
 #             "imgs": self.inverse_transform(x).detach().cpu().numpy(),
 #         }
 
-#     @BaseFeature.collect_feature
 #     @BaseFeature.invoke_callbacks
 #     def __call__(self, x) -> List[torch.FloatTensor]:
 #         x = self.inverse_transform(x)
@@ -454,20 +551,8 @@ class ClusterFeature(Feature):
             **kwargs,
         )
         if self.embedding_model:
-            if self.embedding_model == "resnet34":
-                model = torchvision.models.resnet34
-            elif self.embedding_model == "resnet50":
-                model = torchvision.models.resnet50
-            elif self.embedding_model == "resnet101":
-                model = torchvision.models.resnet101
-            else:
-                raise ValueError(f"Version {self.resnet_version} is not available")
-
-            self.model = model(pretrained=True).to(self.device)
-            self.activation = Holder()
-            self.model.avgpool.register_forward_hook(holder_hook(self.activation))
-            self.model.eval()
-            self.transform = transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))
+            self.model = EmbeddingRegistry.get(self.embedding_model, self.device)
+            self.preprocess = get_preprocess(self.inverse_transform)
         else:
             self.model = None
 
@@ -500,11 +585,7 @@ class ClusterFeature(Feature):
 
     def apply(self, x: torch.FloatTensor) -> List[torch.FloatTensor]:
         if self.model:
-            self.model(self.transform(self.inverse_transform(x)))
-            x = torch.cat([_.to(self.device) for _ in self.activation], 0).view(
-                len(x), -1
-            )
-            self.activation.reset()
+            x = self.model(x, self.preprocess)
         elif self.dis_emb:
             x = penult_layer_activation(self.dis, x)
         else:
@@ -577,22 +658,8 @@ class MMDFeature(Feature):
             **kwargs,
         )
         if self.embedding_model:
-            if self.embedding_model == "resnet34":
-                model = torchvision.models.resnet34
-            elif self.embedding_model == "resnet50":
-                model = torchvision.models.resnet50
-            elif self.embedding_model == "resnet101":
-                model = torchvision.models.resnet101
-            else:
-                raise ValueError(f"Version {self.resnet_version} is not available")
-
-            self.model = model(pretrained=True).to(self.device)
-            self.activation = Holder()
-            self.model.avgpool.register_forward_hook(holder_hook(self.activation))
-            if dp:
-                self.model = torch.nn.DataParallel(self.model)
-            self.model.eval()
-            self.transform = transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))
+            self.model = EmbeddingRegistry.get(self.embedding_model, self.device, dp)
+            self.preprocess = get_preprocess(self.inverse_transform)
         else:
             self.model = None
 
@@ -607,11 +674,7 @@ class MMDFeature(Feature):
                 self.dataiter = iter(dataloader)
                 x = next(self.dataiter).to(self.device)
             if self.model:
-                self.model(self.transform(self.inverse_transform(x)))
-                x = torch.cat([_.to(x.device) for _ in self.activation], 0).view(
-                    len(x), -1
-                )
-                self.activation.reset()
+                x = self.model(x, self.preprocess)
             elif self.dis_emb:
                 x = penult_layer_activation(self.dis, x)
             else:
@@ -639,15 +702,9 @@ class MMDFeature(Feature):
             batch = next(self.dataiter)
         batch = batch.to(x.device)
         if self.model:
-            self.model(self.transform(self.inverse_transform(x)))
-            x = torch.cat([_.to(x.device) for _ in self.activation], 0).view(len(x), -1)
-            self.activation.reset()
+            x = self.model(x, self.preprocess)
 
-            self.model(batch)
-            batch = torch.cat([_.to(batch.device) for _ in self.activation], 0).view(
-                len(batch), -1
-            )
-            self.activation.reset()
+            batch = self.model(batch)
         elif self.dis_emb:
             x = penult_layer_activation(self.dis, x)
             batch = penult_layer_activation(self.dis, batch)
@@ -700,22 +757,8 @@ class CMDFeature(Feature):
             **kwargs,
         )
         if self.embedding_model:
-            if self.embedding_model == "resnet34":
-                model = torchvision.models.resnet34
-            elif self.embedding_model == "resnet50":
-                model = torchvision.models.resnet50
-            elif self.embedding_model == "resnet101":
-                model = torchvision.models.resnet101
-            else:
-                raise ValueError(f"Version {self.resnet_version} is not available")
-
-            self.model = model(pretrained=True).to(self.device)
-            self.activation = Holder()
-            self.model.avgpool.register_forward_hook(holder_hook(self.activation))
-            if dp:
-                self.model = torch.nn.DataParallel(self.model)
-            self.model.eval()
-            self.transform = transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))
+            self.model = EmbeddingRegistry.get(self.embedding_model, self.device, dp)
+            self.preprocess = get_preprocess(self.inverse_transform)
         else:
             self.model = None
 
@@ -733,11 +776,7 @@ class CMDFeature(Feature):
                 self.dataiter = iter(dataloader)
                 x = next(self.dataiter).to(self.device)
             if self.model:
-                self.model(self.transform(self.inverse_transform(x)))
-                x = torch.cat([_.to(x.device) for _ in self.activation], 0).view(
-                    len(x), -1
-                )
-                self.activation.reset()
+                x = self.model(x, self.preprocess)
             elif self.dis_emb:
                 x = penult_layer_activation(self.dis, x)
             else:
@@ -756,9 +795,7 @@ class CMDFeature(Feature):
 
     def apply(self, x: torch.FloatTensor) -> List[torch.FloatTensor]:
         if self.model:
-            self.model(self.transform(self.inverse_transform(x)))
-            x = torch.cat([_.to(x.device) for _ in self.activation], 0).view(len(x), -1)
-            self.activation.reset()
+            x = self.model(x, self.preprocess)
         elif self.dis_emb:
             x = penult_layer_activation(self.dis, x)
         else:
@@ -797,22 +834,8 @@ class PCAFeature(Feature):  # REMOVE
             **kwargs,
         )
         if self.embedding_model:
-            if self.embedding_model == "resnet34":
-                model = torchvision.models.resnet34
-            elif self.embedding_model == "resnet50":
-                model = torchvision.models.resnet50
-            elif self.embedding_model == "resnet101":
-                model = torchvision.models.resnet101
-            else:
-                raise ValueError(f"Version {self.resnet_version} is not available")
-
-            self.model = model(pretrained=True).to(self.device)
-            self.activation = Holder()
-            self.model.avgpool.register_forward_hook(holder_hook(self.activation))
-            if dp:
-                self.model = torch.nn.DataParallel(self.model)
-            self.model.eval()
-            self.transform = transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))
+            self.model = EmbeddingRegistry.get(self.embedding_model, self.device, dp)
+            self.preprocess = get_preprocess(self.inverse_transform)
         else:
             self.model = None
 
@@ -820,9 +843,7 @@ class PCAFeature(Feature):  # REMOVE
 
     def apply(self, x: torch.FloatTensor) -> List[torch.FloatTensor]:
         if self.model:
-            self.model(self.transform(self.inverse_transform(x)))
-            x = torch.cat([_.to(x.device) for _ in self.activation], 0).view(len(x), -1)
-            self.activation.reset()
+            x = self.model(x, self.preprocess)
 
         result = (
             (x.reshape(len(x), -1) - self.mean[None, :].to(x.device))
@@ -863,22 +884,8 @@ class KernelPCAFeature(Feature):  # REMOVE
             **kwargs,
         )
         if self.embedding_model:
-            if self.embedding_model == "resnet34":
-                model = torchvision.models.resnet34
-            elif self.embedding_model == "resnet50":
-                model = torchvision.models.resnet50
-            elif self.embedding_model == "resnet101":
-                model = torchvision.models.resnet101
-            else:
-                raise ValueError(f"Version {self.resnet_version} is not available")
-
-            self.model = model(pretrained=True).to(self.device)
-            self.activation = Holder()
-            self.model.avgpool.register_forward_hook(holder_hook(self.activation))
-            if dp:
-                self.model = torch.nn.DataParallel(self.model)
-            self.model.eval()
-            self.transform = transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))
+            self.model = EmbeddingRegistry.get(self.embedding_model, self.device, dp)
+            self.preprocess = get_preprocess(self.inverse_transform)
         else:
             self.model = None
 
@@ -886,9 +893,7 @@ class KernelPCAFeature(Feature):  # REMOVE
 
     def apply(self, x: torch.FloatTensor) -> List[torch.FloatTensor]:
         if self.model:
-            self.model(self.transform(self.inverse_transform(x)))
-            x = torch.cat([_.to(x.device) for _ in self.activation], 0).view(len(x), -1)
-            self.activation.reset()
+            x = self.model(x, self.preprocess)
         device = x.device
         K = torch.exp(
             -self.gamma
@@ -965,7 +970,6 @@ class InceptionV3MeanFeature(BaseFeature):
         }
 
     @BaseFeature.invoke_callbacks
-    @BaseFeature.collect_feature
     def __call__(self, x) -> List[torch.FloatTensor]:
         x = self.inverse_transform(x)
         pred = self.model(x)[0]
@@ -1016,7 +1020,6 @@ class DumbFeature(BaseFeature):
         }
 
     @BaseFeature.invoke_callbacks
-    @BaseFeature.collect_feature
     def __call__(
         self, x, z: Optional[torch.FloatTensor] = None
     ) -> List[torch.FloatTensor]:
@@ -1044,21 +1047,11 @@ class EfficientNetFeature(Feature):
             inverse_transform=inverse_transform,
             **kwargs,
         )
-        self.model = torchvision.models.efficientnet_b3(pretrained=True).to(self.device)
-        self.activation = Holder()
-        self.model.avgpool.register_forward_hook(holder_hook(self.activation))
-        if dp:
-            self.model = torch.nn.DataParallel(self.model)
-        self.model.eval()
-        self.transform = transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))
+        self.model = EmbeddingRegistry.get("efficientnet_b3", self.device, dp)
+        self.preprocess = get_preprocess(self.inverse_transform, normalize_first=True)
 
     def apply(self, x: torch.FloatTensor) -> List[torch.FloatTensor]:
-        x = self.inverse_transform(self.transform(x))
-        self.model(x)
-        out = torch.cat([_.to(self.device) for _ in self.activation], 0).view(
-            len(x), -1
-        )
-        self.activation.reset()
+        out = self.model(x, self.preprocess)
 
         return [out]
 
@@ -1081,32 +1074,13 @@ class ResnetFeature(Feature):
             inverse_transform=inverse_transform,
             **kwargs,
         )
-        if self.resnet_version == 18:
-            model = torchvision.models.resnet18
-        elif self.resnet_version == 34:
-            model = torchvision.models.resnet34
-        elif self.resnet_version == 50:
-            model = torchvision.models.resnet50
-        elif self.resnet_version == 101:
-            model = torchvision.models.resnet101
-        else:
-            raise ValueError(f"Version {self.resnet_version} is not available")
-
-        self.model = model(pretrained=True).to(self.device)
-        self.activation = Holder()
-        self.model.avgpool.register_forward_hook(holder_hook(self.activation))
-        if dp:
-            self.model = torch.nn.DataParallel(self.model)
-        self.model.eval()
-        self.transform = transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5))
+        self.model = EmbeddingRegistry.get(
+            f"resnet{self.resnet_version}", self.device, dp
+        )
+        self.preprocess = get_preprocess(self.inverse_transform, normalize_first=True)
 
     def apply(self, x: torch.FloatTensor) -> List[torch.FloatTensor]:
-        x = self.inverse_transform(self.transform(x))
-        self.model(x)
-        out = torch.cat([_.to(self.device) for _ in self.activation], 0).view(
-            len(x), -1
-        )
-        self.activation.reset()
+        out = self.model(x, self.preprocess)
 
         return [out]
 
@@ -1151,8 +1125,17 @@ class SumFeature(BaseFeature):
         for feature in self.features:
             feature.init_weight()
 
+    def state_dict(self) -> Dict[str, Any]:
+        state = super().state_dict()
+        state["features"] = [feature.state_dict() for feature in self.features]
+        return state
+
+    def load_state_dict(self, state: Dict[str, Any]):
+        for feature, feature_state in zip(self.features, state["features"]):
+            feature.load_state_dict(feature_state)
+        super().load_state_dict(state)
+
     @BaseFeature.invoke_callbacks
-    @BaseFeature.collect_feature
     def __call__(self, x: torch.FloatTensor):
         outs = []
         for feature in self.features:
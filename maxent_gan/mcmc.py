@@ -1,8 +1,12 @@
-from typing import Callable, Dict, Optional, Tuple, Union
+import functools
+import inspect
+import logging
+from typing import Callable, Dict, Generator, Iterator, List, Optional, Tuple, Union
 
 import numpy as np
 import torch
-from pyro.infer import HMC, MCMC
+import torch.distributed as dist
+from scipy.special import gammaincinv
 from torch.distributions import Normal  # noqa: F401
 from torch.distributions import Categorical
 from torch.distributions import Distribution as torchDist
@@ -35,8 +39,315 @@ class MCMCRegistry:
         chains, meta = exec(*args, **kwargs)
         return chains, meta
 
+    @classmethod
+    def stream(
+        cls, name: str, *args, **kwargs
+    ) -> Iterator[Tuple[int, torch.FloatTensor, Dict]]:
+        """
+        Runs kernel step by step
+
+        Yields tuples (step_id, state, meta_delta) after each iteration, where
+        meta_delta holds per-iteration statistics (acceptance rates, step sizes).
+        The yielded state may be updated in place by the next iteration,
+        so it has to be copied if it is kept.
+        """
+        exec = cls.registry[name]
+        if not hasattr(exec, "stream"):
+            raise NotImplementedError(f"Kernel {name} does not support streaming")
+        kwargs["project"] = kwargs.get("project", lambda _: _)
+        return exec.stream(*args, **kwargs)
+
+
+class ChainBuffer:
+    """
+    Preallocated storage for the states kept by a sampler
+
+    States are written in place into a tensor of shape [n_kept, n_chains, dim]
+    which is allocated on the first write, so no intermediate list of tensors
+    is kept and no extra copy is made when the chains are returned.
+
+    Args:
+        n_samples - number of last samples from each chain to keep
+        burn_in - number of first samples from each chain to throw away
+        thinning - keep every thinning-th state after burn-in
+        device - device to store chains on (defaults to the device of states)
+        pin_memory - whether to pin storage (only for CPU storage)
+        keep_graph - keep states attached to the computational graph
+    """
+
+    def __init__(
+        self,
+        n_samples: int,
+        burn_in: int,
+        *,
+        thinning: int = 1,
+        device: Optional[Union[str, torch.device]] = None,
+        pin_memory: bool = False,
+        keep_graph: bool = False,
+    ):
+        if thinning < 1:
+            raise ValueError("Thinning should be positive")
+        self.n_samples = n_samples
+        self.burn_in = burn_in
+        self.thinning = thinning
+        self.device = torch.device(device) if device is not None else None
+        self.pin_memory = pin_memory
+        self.keep_graph = keep_graph
+        self.n_kept = (n_samples + thinning - 1) // thinning
+        self.storage: Optional[torch.Tensor] = None
+        self.graph_states: List[torch.Tensor] = []
+        self.n_written = 0
+        self.pending_copies = False
+
+    def keeps(self, step_id: int) -> bool:
+        return step_id >= self.burn_in and (step_id - self.burn_in) % self.thinning == 0
+
+    def allocate(self, state: torch.Tensor):
+        device = self.device or state.device
+        pin_memory = (
+            self.pin_memory and device.type == "cpu" and torch.cuda.is_available()
+        )
+        self.storage = torch.empty(
+            (self.n_kept, *state.shape),
+            dtype=state.dtype,
+            device=device,
+            pin_memory=pin_memory,
+        )
+
+    def push(self, step_id: int, state: torch.Tensor):
+        if not self.keeps(step_id):
+            return
+        if self.keep_graph:
+            # in-place writes would break the graph between kept states
+            self.graph_states.append(state)
+        else:
+            if self.storage is None:
+                self.allocate(state)
+            non_blocking = self.storage.is_pinned() and state.is_cuda
+            self.storage[self.n_written].copy_(
+                state.detach(), non_blocking=non_blocking
+            )
+            self.pending_copies |= non_blocking
+        self.n_written += 1
+
+    @property
+    def data(self) -> torch.FloatTensor:
+        if self.keep_graph:
+            return torch.stack(self.graph_states, 0)
+        if self.storage is None:
+            raise ValueError("No states were written to the buffer")
+        if self.pending_copies:
+            torch.cuda.synchronize()
+            self.pending_copies = False
+        return self.storage[: self.n_written]
+
+
+KernelStream = Generator[Tuple[int, torch.FloatTensor, Dict], None, Dict]
+
+
+def collect_chains(kernel: Callable[..., KernelStream]) -> Callable:
+    """
+    Turns streaming kernel into function returning (chains, meta)
+
+    Streaming kernel is a generator yielding (step_id, state, meta_delta) and
+    returning meta. Kept states are written to ChainBuffer, the generator
+    itself is available as attribute "stream" of the returned function.
+    """
+    signature = inspect.signature(kernel)
+
+    @functools.wraps(kernel)
+    def collected(
+        *args,
+        thinning: int = 1,
+        chain_device: Optional[Union[str, torch.device]] = None,
+        pin_memory: bool = False,
+        **kwargs,
+    ) -> Tuple[torch.FloatTensor, Dict]:
+        arguments = signature.bind(*args, **kwargs).arguments
+        chains = ChainBuffer(
+            arguments["n_samples"],
+            arguments["burn_in"],
+            thinning=thinning,
+            device=chain_device,
+            pin_memory=pin_memory,
+            keep_graph=arguments.get("keep_graph", False),
+        )
+        stream = kernel(*args, **kwargs)
+        while True:
+            try:
+                step_id, point, _ = next(stream)
+            except StopIteration as stop:
+                return chains.data, stop.value
+            chains.push(step_id, point)
+
+    collected.stream = kernel
+    return collected
+
+
+def last_state(stream: KernelStream) -> Tuple[torch.FloatTensor, Dict]:
+    """Runs streaming kernel to the end, returns last state and meta"""
+    point = None
+    while True:
+        try:
+            _, point, _ = next(stream)
+        except StopIteration as stop:
+            return point, stop.value
+
+
+def log_prob_and_grad(
+    point: torch.FloatTensor,
+    target: Union[Distribution, torchDist],
+    keep_graph: bool = False,
+) -> Tuple[torch.FloatTensor, torch.FloatTensor]:
+    if not keep_graph and hasattr(target, "log_prob_and_grad"):
+        # chunked forward and backward passes
+        return target.log_prob_and_grad(point)
+    logp = target.log_prob(point)
+    grad = torch.autograd.grad(
+        logp.sum(), point, create_graph=keep_graph, retain_graph=keep_graph
+    )[0]
+    if not keep_graph:
+        logp, grad = logp.detach(), grad.detach()
+    return logp, grad
+
+
+def notify_accept(
+    target: Union[Distribution, torchDist], mask: Optional[torch.Tensor] = None
+):
+    """
+    Tells target which chains moved to the last evaluated points
+    (all chains if mask is None), so it can keep per-chain state aligned
+    """
+    if hasattr(target, "accept"):
+        target.accept(mask)
+
+
+class Preconditioner:
+    """
+    Preconditioner (inverse mass matrix) C = diag(d) + U U^T estimated
+    from warm-up samples of all chains
+
+    Until the end of warm-up C is identity. Diagonal is estimated with
+    running (Welford) variances, low-rank part is given by leading principal
+    components of the warm-up samples kept in a reservoir buffer.
+
+    Args:
+        dim - dimension of points
+        rank - rank of U, diagonal preconditioner if 0
+        n_warmup - number of warm-up iterations (counted across calls)
+        buffer_size - number of warm-up samples kept to estimate U
+        eps - minimal value of the diagonal
+    """
+
+    def __init__(
+        self,
+        dim: int,
+        *,
+        rank: int = 0,
+        n_warmup: int = 100,
+        buffer_size: int = 4096,
+        eps: float = 1e-3,
+    ):
+        self.dim = dim
+        self.rank = rank
+        self.n_warmup = n_warmup
+        self.eps = eps
+        self.t = 0
+        self.n = 0
+        self.mean: Optional[torch.Tensor] = None
+        self.m2: Optional[torch.Tensor] = None
+        self.buffer = ReplayBuffer(buffer_size, "reservoir") if rank > 0 else None
+        self.diag: Optional[torch.Tensor] = None
+        self.factor: Optional[torch.Tensor] = None
+
+    @property
+    def adapting(self) -> bool:
+        return self.t < self.n_warmup
+
+    def to(self, device: Union[str, int, torch.device]) -> "Preconditioner":
+        for name in ["mean", "m2", "diag", "factor"]:
+            if getattr(self, name) is not None:
+                setattr(self, name, getattr(self, name).to(device))
+        if self.buffer is not None:
+            self.buffer.to(device)
+        return self
+
+    @torch.no_grad()
+    def update(self, points: torch.Tensor):
+        points = points.detach().reshape(-1, self.dim).float()
+        if self.mean is None:
+            self.mean = torch.zeros(self.dim, device=points.device)
+            self.m2 = torch.zeros(self.dim, device=points.device)
+        # batched Welford update
+        n_new = points.shape[0]
+        mean_new = points.mean(0)
+        delta = mean_new - self.mean
+        total = self.n + n_new
+        self.mean += delta * n_new / total
+        self.m2 += ((points - mean_new) ** 2).sum(0)
+        self.m2 += delta ** 2 * self.n * n_new / total
+        self.n = total
+        if self.buffer is not None:
+            self.buffer.push(points, torch.zeros(n_new, device=points.device))
+
+        self.t += 1
+        if not self.adapting:
+            self.fit()
+
+    @torch.no_grad()
+    def fit(self):
+        var = self.m2 / max(self.n - 1, 1)
+        if self.buffer is None or len(self.buffer) <= self.rank:
+            self.diag = var.clamp(min=self.eps)
+            return
+        samples = self.buffer.points[: len(self.buffer)]
+        samples = samples - samples.mean(0)
+        cov = samples.T @ samples / (len(samples) - 1)
+        eigvals, eigvecs = torch.linalg.eigh(cov)
+        # leading components above the level of the rest of the spectrum
+        top = eigvals[-self.rank :].clamp(min=0)
+        level = eigvals[-self.rank - 1].clamp(min=0) if self.rank < self.dim else 0
+        self.factor = eigvecs[:, -self.rank :] * (top - level).sqrt()
+        self.diag = (var - (self.factor ** 2).sum(1)).clamp(min=self.eps)
+
+    def mv(self, x: torch.Tensor) -> torch.Tensor:
+        """C x for x of shape [..., dim]"""
+        if self.diag is None:
+            return x
+        result = x * self.diag
+        if self.factor is not None:
+            result = result + (x @ self.factor) @ self.factor.T
+        return result
+
+    def sample(self, shape: torch.Size, device=None) -> torch.Tensor:
+        """Samples from N(0, C) of shape [*shape, dim]"""
+        noise = torch.randn((*shape, self.dim), device=device)
+        if self.diag is None:
+            return noise
+        noise = noise * self.diag.sqrt()
+        if self.factor is not None:
+            low_rank_noise = torch.randn((*shape, self.rank), device=device)
+            noise = noise + low_rank_noise @ self.factor.T
+        return noise
+
+    def inv_quad(self, x: torch.Tensor) -> torch.Tensor:
+        """x^T C^{-1} x for x of shape [..., dim] (Woodbury identity for U)"""
+        if self.diag is None:
+            return (x ** 2).sum(-1)
+        x_scaled = x / self.diag
+        result = (x * x_scaled).sum(-1)
+        if self.factor is not None:
+            capacitance = torch.eye(self.rank, device=x.device) + self.factor.T @ (
+                self.factor / self.diag[:, None]
+            )
+            proj = x_scaled @ self.factor
+            correction = torch.linalg.solve(capacitance, proj.T).T
+            result = result - (proj * correction).sum(-1)
+        return result
+
 
 @MCMCRegistry.register()
+@collect_chains
 def ula(
     start: torch.FloatTensor,
     target: Union[Distribution, torchDist],
@@ -45,11 +356,13 @@ def ula(
     burn_in: int,
     project: Callable,
     *,
-    step_size: float,
+    step_size: Union[float, torch.Tensor],
     verbose: bool = False,
     meta: Optional[Dict] = None,
     keep_graph: bool = False,
-) -> Tuple[torch.FloatTensor, Dict]:
+    preconditioner: Optional[Preconditioner] = None,
+    fused: bool = True,
+) -> KernelStream:
     """
     Unadjusted Langevin Algorithm
 
@@ -58,39 +371,168 @@ def ula(
         target - target distribution instance with method "log_prob"
         n_samples - number of last samples from each chain to return
         burn_in - number of first samples from each chain to throw away
-        step_size - step size for drift term
+        step_size - step size for drift term, scalar or tensor of shape [n_chains]
         verbose - whether to show iterations' bar
+        preconditioner - preconditioner applied to drift and noise, updated
+            with new points while adapting
+        fused - whether to use compiled update of points (if graph is not kept
+            and there is no preconditioner)
+        thinning - keep every thinning-th sample after burn-in
+        chain_device - device to store chains on
+        pin_memory - whether to pin chains storage (if stored on CPU)
 
     Returns:
-        tensor of chains with shape [n_samples, n_chains, dim]
+        tensor of chains with shape [ceil(n_samples / thinning), n_chains, dim]
     """
-    chains = []
     meta = meta or dict()
 
     point = start.clone()
     point.requires_grad_(True)
     point.grad = None
+    fused = fused and not keep_graph and preconditioner is None
 
     pbar = trange if verbose else range
     for step_id in pbar(n_samples + burn_in):
-        logp = target.log_prob(point)
-        grad = torch.autograd.grad(
-            logp.sum(), point, create_graph=keep_graph, retain_graph=keep_graph
-        )[0]
-        noise = torch.randn_like(point, dtype=torch.float).to(point.device)
-        noise_scale = (2.0 * step_size) ** 0.5
-
-        point = point + step_size * grad + noise_scale * noise
+        _, grad = log_prob_and_grad(point, target, keep_graph)
+        notify_accept(target)
+        step = broadcast_step_size(step_size, point)
+        if fused:
+            step = torch.as_tensor(step, dtype=point.dtype, device=point.device)
+            with torch.no_grad():
+                point = fused_langevin_step(point, grad, torch.randn_like(point), step)
+            point = project(point).requires_grad_()
+            yield step_id, point, dict()
+            continue
+        noise_scale = (2.0 * step) ** 0.5
+        if preconditioner is not None:
+            noise = preconditioner.sample(point.shape[:-1], device=point.device)
+            grad = preconditioner.mv(grad)
+        else:
+            noise = torch.randn_like(point, dtype=torch.float).to(point.device)
+
+        point = point + step * grad + noise_scale * noise
         point = project(point)
 
         if not keep_graph:
             point = point.detach().requires_grad_()
-        if step_id >= burn_in:
-            chains.append(point)
-    chains = torch.stack(chains, 0)
-    meta["mask"] = torch.ones(point.shape[0], dtype=torch.bool)
+        if preconditioner is not None and preconditioner.adapting:
+            preconditioner.update(point)
+        yield step_id, point, dict()
+    meta["mask"] = torch.ones(point.shape[0], dtype=torch.bool, device=point.device)
+
+    return meta
+
+
+def particles_log_prob_and_grad(
+    particles: torch.FloatTensor, target
+) -> Tuple[torch.FloatTensor, torch.FloatTensor]:
+    """
+    Target log-density and its gradient for a batch of particles in one
+    backward pass, graph to proposal parameters (if particles depend on them)
+    is kept in the returned log-density
+    """
+    keep_graph = particles.grad_fn is not None
+    if not keep_graph:
+        return log_prob_and_grad(particles, target)
+    logp = target.log_prob(particles)
+    grad = torch.autograd.grad(logp.sum(), particles, retain_graph=keep_graph)[0]
+    return (logp if keep_graph else logp.detach()), grad.detach()
+
 
-    return chains, meta
+class StructuredProposal:
+    """
+    Gaussian proposal drawing a structured set of particles for each chain
+
+    Every particle is marginally distributed as the wrapped proposal (so i-SIR
+    weights are computed with its log-density as usual), while particles of
+    one chain are negatively dependent and cover the space more evenly than
+    i.i.d. draws. Draws are vectorised over chains and reproducible from seed.
+
+    Args:
+        proposal - Gaussian proposal (MultivariateNormal or Normal with event
+            dimension), has to be set before sampling
+        mode - "sobol" (scrambled Sobol points through the inverse normal CDF,
+            randomly shifted for each chain), "antithetic" (pairs eps, -eps
+            around the mean) or "stratified" (stratified radii with uniform
+            directions)
+        seed - seed of the internal generator, offset by the process rank
+            if chains are sharded
+    """
+
+    modes = ["sobol", "antithetic", "stratified"]
+
+    def __init__(
+        self,
+        proposal: Optional[torchDist],
+        mode: str = "sobol",
+        seed: Optional[int] = None,
+    ):
+        if mode not in self.modes:
+            raise ValueError(f"Unknown proposal stream {mode}")
+        self.proposal = proposal
+        self.mode = mode
+        if seed is not None and dist.is_available() and dist.is_initialized():
+            seed += dist.get_rank()
+        self.generator = torch.Generator()
+        if seed is None:
+            self.generator.seed()
+        else:
+            self.generator.manual_seed(seed)
+        self.seed = int(self.generator.initial_seed())
+        self.sobol: Optional[torch.quasirandom.SobolEngine] = None
+
+    def __getstate__(self) -> Dict:
+        # generator is not picklable, proposal is reattached by the kernel
+        state = self.__dict__.copy()
+        state["generator"] = self.generator.get_state()
+        state["proposal"] = None
+        return state
+
+    def __setstate__(self, state: Dict):
+        generator = torch.Generator()
+        generator.set_state(state["generator"])
+        self.__dict__.update(state, generator=generator)
+
+    def log_prob(self, z: torch.FloatTensor) -> torch.FloatTensor:
+        return self.proposal.log_prob(z)
+
+    def project(self, z: torch.FloatTensor) -> torch.FloatTensor:
+        return self.proposal.project(z)
+
+    def standard_normal(self, n_chains: int, n: int, dim: int) -> torch.Tensor:
+        """Structured N(0, I) draws of shape [n_chains, n, dim] on CPU"""
+        if self.mode == "sobol":
+            if self.sobol is None or self.sobol.dimension != dim:
+                self.sobol = torch.quasirandom.SobolEngine(
+                    dim, scramble=True, seed=self.seed
+                )
+            points = self.sobol.draw(n)
+            # Cranley-Patterson rotation gives an independent set for each chain
+            shift = torch.rand((n_chains, 1, dim), generator=self.generator)
+            u = torch.frac(points[None] + shift).clamp(1e-6, 1 - 1e-6)
+            return 2 ** 0.5 * torch.erfinv(2 * u - 1)
+        elif self.mode == "antithetic":
+            eps = torch.randn((n_chains, (n + 1) // 2, dim), generator=self.generator)
+            return torch.cat([eps, -eps], 1)[:, :n]
+        else:
+            # one radius from each of n equiprobable strata of chi distribution
+            strata = torch.argsort(torch.rand((n_chains, n), generator=self.generator))
+            u = (strata + torch.rand((n_chains, n), generator=self.generator)) / n
+            radius = np.sqrt(2 * gammaincinv(dim / 2, u.double().numpy()))
+            direction = torch.randn((n_chains, n, dim), generator=self.generator)
+            direction = direction / direction.norm(dim=-1, keepdim=True)
+            return direction * torch.from_numpy(radius).float()[..., None]
+
+    def sample(self, shape: Tuple[int, int]) -> torch.FloatTensor:
+        """Samples particles of shape [n_chains, n_particles, dim]"""
+        n_chains, n = shape
+        loc = self.proposal.loc
+        dim = loc.shape[-1]
+        eps = self.standard_normal(n_chains, n, dim).to(loc)
+        scale_tril = getattr(self.proposal, "scale_tril", None)
+        if scale_tril is not None:
+            return loc + eps @ scale_tril.transpose(-1, -2)
+        return loc + eps * self.proposal.scale
 
 
 @MCMCRegistry.register()
@@ -102,25 +544,99 @@ def isir_step(
     n_particles: int,
     logp_x=None,
     logq_x=None,
+    grad_x=None,
+    return_grad: bool = False,
 ) -> Tuple:
+    """
+    One step of i-SIR
+
+    Args:
+        start - current points of shape [n_chains, dim]
+        n_particles - number of particles including the current point
+        logp_x, logq_x, grad_x - target and proposal log-densities and
+            target gradient at the current point (computed if not given)
+        return_grad - whether to return target gradients for all particles,
+            computed with one batched backward pass
+
+    Returns:
+        selected points, particles, log_ps, log_qs, indices of selected
+        particles (and gradients of log_ps w.r.t. particles if return_grad)
+    """
     point = start.clone()
-    logp_x = target.log_prob(point) if logp_x is None else logp_x
     logq_x = proposal.log_prob(point) if logq_x is None else logq_x
 
     particles = proposal.sample((point.shape[0], n_particles - 1))
     log_qs = torch.cat([logq_x[:, None], proposal.log_prob(particles)], 1)
-    log_ps = torch.cat([logp_x[:, None], target.log_prob(particles)], 1)
-    particles = torch.cat([point[:, None, :], particles], 1)
+    if return_grad:
+        if logp_x is None or grad_x is None:
+            # current point goes into the same batched forward / backward pass
+            particles = torch.cat([point.detach()[:, None, :], particles], 1)
+            log_ps, grads = particles_log_prob_and_grad(particles, target)
+        else:
+            logp_particles, grad_particles = particles_log_prob_and_grad(
+                particles, target
+            )
+            particles = torch.cat([point[:, None, :], particles], 1)
+            log_ps = torch.cat([logp_x.detach()[:, None], logp_particles], 1)
+            grads = torch.cat([grad_x.detach()[:, None], grad_particles], 1)
+    else:
+        logp_x = target.log_prob(point) if logp_x is None else logp_x
+        log_ps = torch.cat([logp_x[:, None], target.log_prob(particles)], 1)
+        particles = torch.cat([point[:, None, :], particles], 1)
 
     log_weights = log_ps - log_qs
     indices = Categorical(logits=log_weights).sample()
 
     x = particles[np.arange(point.shape[0]), indices]
 
+    if return_grad:
+        return x, particles.detach(), log_ps, log_qs, indices, grads
     return x, particles.detach(), log_ps, log_qs, indices
 
 
+def rao_blackwellise(
+    meta: Dict,
+    target,
+    log_ps: torch.FloatTensor,
+    log_qs: torch.FloatTensor,
+    indices: torch.LongTensor,
+):
+    """
+    Appends self-normalised importance estimates over all particles of i-SIR
+    step to meta: mean energy to meta["rb_energy"] and, if target keeps
+    features of the last evaluated batch (as MaxEntTarget does), average
+    features to meta["rb_feature"]. Features of current points (particle 0)
+    are taken from the target's chain state if they were not re-evaluated.
+    """
+    log_weights = (log_ps - log_qs).detach().cpu()
+    weights = torch.softmax(log_weights, dim=1)
+    meta["rb_energy"].append(-(weights * log_ps.detach().cpu()).sum(1).mean().item())
+
+    feature_out = getattr(target, "last_feature_out", None)
+    if feature_out is None:
+        return
+    feature_x = getattr(target, "chain_feature_out", None)
+    if feature_x is not None and len(feature_x[0]) != len(indices):
+        feature_x = None
+    estimate = []
+    for i, out in enumerate(feature_out):
+        out = out.float()
+        w = weights
+        if out.shape[1] < weights.shape[1]:
+            if feature_x is None:
+                # current points' features are unknown, use new particles only
+                w = torch.softmax(log_weights[:, 1:], dim=1)
+            else:
+                out_x = feature_x[i].float().reshape(len(out), 1, -1)
+                out = torch.cat([out_x.to(out.device), out], 1)
+        # features are kept on the device they were computed on
+        w = w.to(out.device)
+        estimate.append((w[..., None] * out).sum(1).mean(0))
+    meta["rb_feature"].append(estimate)
+
+
 @MCMCRegistry.register()
+@collect_chains
 def isir(
     start: torch.FloatTensor,
     target,
@@ -132,7 +648,12 @@ def isir(
     n_particles: int,
     verbose: bool = False,
     meta: Optional[Dict] = None,
-) -> Tuple[torch.FloatTensor, Dict]:
+    keep_graph: bool = False,
+    return_grad: bool = False,
+    rao_blackwell: bool = False,
+    proposal_stream: str = "iid",
+    proposal_seed: Optional[int] = None,
+) -> KernelStream:
     """
     Iterated Sampling Importance Resampling
 
@@ -144,42 +665,70 @@ def isir(
         burn_in - number of first samples from each chain to throw away
         n_particles - number of particles including one from previous step
         verbose - whether to show iterations' bar
+        return_grad - whether to keep target gradient of the selected points
+            in meta["grad"] (computed for all particles in one backward pass)
+        rao_blackwell - whether to append importance weighted estimates over
+            all particles for each iteration to meta["rb_energy"] and
+            meta["rb_feature"] (consumed by MaxEntSampler)
+        proposal_stream - "iid" or structured particles of a Gaussian proposal:
+            "sobol", "antithetic", "stratified" (see StructuredProposal)
+        proposal_seed - seed of the structured proposal stream
+        thinning - keep every thinning-th sample after burn-in
+        chain_device - device to store chains on
+        pin_memory - whether to pin chains storage (if stored on CPU)
 
     Returns:
-        tensor of chains with shape [n_samples, n_chains, dim], meta
+        tensor of chains with shape [ceil(n_samples / thinning), n_chains, dim], meta
     """
-    chains = []
     point = start.clone()
     # point = project(start)
 
     meta = meta or dict()
     meta["sir_accept"] = meta.get("sir_accept", [])
-    meta["logp"] = meta.get("logp", target.log_prob(point))
-    logp_x = meta["logp"]
+    logp_x = meta.get("logp")
+    grad_x = meta.pop("grad", None)
     logq_x = proposal.log_prob(point)
+    if rao_blackwell:
+        meta["rb_energy"] = meta.get("rb_energy", [])
+        meta["rb_feature"] = meta.get("rb_feature", [])
+    if proposal_stream != "iid":
+        # stream state is kept in meta to continue the sequence between calls
+        structured = meta.get("structured_proposal")
+        if structured is None or structured.mode != proposal_stream:
+            structured = StructuredProposal(None, proposal_stream, proposal_seed)
+        structured.proposal = proposal
+        meta["structured_proposal"] = structured
+        proposal = structured
 
     pbar = trange if verbose else range
     for step_id in pbar(n_samples + burn_in):
-        point, _, log_qs, log_ps, indices = isir_step(
+        point, _, log_ps, log_qs, indices, *grads = isir_step(
             point,
             target,
             proposal,
             n_particles=n_particles,
             logp_x=logp_x,
             logq_x=logq_x,
+            grad_x=grad_x,
+            return_grad=return_grad,
         )
         logp_x = log_ps[np.arange(point.shape[0]), indices]
         logq_x = log_qs[np.arange(point.shape[0]), indices]
+        if return_grad:
+            grad_x = grads[0][np.arange(point.shape[0]), indices]
+        if rao_blackwell:
+            rao_blackwellise(meta, target, log_ps, log_qs, indices)
+        notify_accept(target, F.one_hot(indices, num_classes=n_particles).bool())
         meta["sir_accept"].append((indices != 0).float().mean().item())
 
-        if step_id >= burn_in:
-            chains.append(point)
-    chains = torch.stack(chains, 0)
+        yield step_id, point, dict(sir_accept=meta["sir_accept"][-1])
 
     meta["logp"] = logp_x
-    meta["mask"] = F.one_hot(indices, num_classes=n_particles).to(bool).detach().cpu()
+    if return_grad:
+        meta["grad"] = grad_x
+    meta["mask"] = F.one_hot(indices, num_classes=n_particles).to(bool).detach()
 
-    return chains, meta
+    return meta
 
 
 def heuristics_step_size(
@@ -196,7 +745,191 @@ def heuristics_step_size(
     return step_size
 
 
+class DualAveragingStepSize:
+    """
+    Dual averaging step size adaptation (Hoffman & Gelman, 2014, Algorithm 5)
+
+    Vectorised over chains: step size might be a scalar tensor (adapted from
+    the mean acceptance probability) or a tensor of shape [n_chains]
+    (each chain is adapted from its own acceptance probability).
+
+    Args:
+        step_size - initial step size
+        target_acceptance - desired acceptance probability
+        gamma, t0, kappa - parameters of dual averaging
+    """
+
+    def __init__(
+        self,
+        step_size: torch.Tensor,
+        target_acceptance: float,
+        *,
+        gamma: float = 0.05,
+        t0: float = 10.0,
+        kappa: float = 0.75,
+    ):
+        self.target_acceptance = target_acceptance
+        self.gamma = gamma
+        self.t0 = t0
+        self.kappa = kappa
+        self.t = 0
+        self.log_step_size = torch.log(step_size.detach().float())
+        self.mu = self.log_step_size + np.log(10.0)
+        # overwritten by the first update, initial step size if never adapted
+        self.log_avg_step_size = self.log_step_size.clone()
+        self.h_bar = torch.zeros_like(self.log_step_size)
+
+    def update(self, accept_prob: torch.Tensor) -> torch.Tensor:
+        accept_prob = accept_prob.detach().float()
+        if self.log_step_size.ndim == 0:
+            accept_prob = accept_prob.mean()
+        self.t += 1
+        eta = 1.0 / (self.t + self.t0)
+        self.h_bar = (1 - eta) * self.h_bar + eta * (
+            self.target_acceptance - accept_prob
+        )
+        self.log_step_size = self.mu - self.t ** 0.5 / self.gamma * self.h_bar
+        weight = self.t ** (-self.kappa)
+        self.log_avg_step_size = (
+            weight * self.log_step_size + (1 - weight) * self.log_avg_step_size
+        )
+        return self.step_size
+
+    def to(self, device: Union[str, int, torch.device]) -> "DualAveragingStepSize":
+        for name in ["log_step_size", "mu", "log_avg_step_size", "h_bar"]:
+            setattr(self, name, getattr(self, name).to(device))
+        return self
+
+    @property
+    def step_size(self) -> torch.Tensor:
+        return self.log_step_size.exp()
+
+    @property
+    def avg_step_size(self) -> torch.Tensor:
+        return self.log_avg_step_size.exp()
+
+
+def broadcast_step_size(
+    step_size: Union[float, torch.Tensor], point: torch.Tensor
+) -> Union[float, torch.Tensor]:
+    """Reshapes per-chain step size for broadcasting over points"""
+    if isinstance(step_size, torch.Tensor) and step_size.ndim > 0:
+        return step_size.reshape(-1, *[1] * (point.ndim - 1))
+    return step_size
+
+
+def init_step_size(
+    step_size: Union[float, torch.Tensor], point: torch.Tensor, per_chain: bool
+) -> Union[float, torch.Tensor]:
+    if per_chain and not (
+        isinstance(step_size, torch.Tensor) and step_size.ndim > 0
+    ):
+        step_size = torch.full(
+            point.shape[:1], float(step_size), device=point.device
+        )
+    return step_size
+
+
+def script(function: Callable) -> Callable:
+    """Compiles function with TorchScript, falls back to eager function"""
+    try:
+        return torch.jit.script(function)
+    except Exception as error:
+        logging.getLogger(__name__).warning(
+            f"Scripting of {function.__name__} failed, eager version is used: {error}"
+        )
+        return function
+
+
+@script
+def fused_langevin_step(
+    point: torch.Tensor, drift: torch.Tensor, noise: torch.Tensor, step: torch.Tensor
+) -> torch.Tensor:
+    return point + step * drift + torch.sqrt(2 * step) * noise
+
+
+@script
+def fused_mala_correction(
+    point: torch.Tensor,
+    proposal_point: torch.Tensor,
+    logp_x: torch.Tensor,
+    logp_y: torch.Tensor,
+    grad_x: torch.Tensor,
+    grad_y: torch.Tensor,
+    noise: torch.Tensor,
+    step: torch.Tensor,
+    u: torch.Tensor,
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    MH correction of MALA with N(0, I) noise, normalising constants cancel
+
+    Returns:
+        new points, their log-densities and gradients, acceptance
+        probabilities, accept mask
+    """
+    log_qyx = -0.5 * noise.pow(2).sum(-1)
+    backward_noise = (point - proposal_point - step * grad_y) / torch.sqrt(2 * step)
+    log_qxy = -0.5 * backward_noise.pow(2).sum(-1)
+    accept_prob = torch.clamp((logp_y + log_qxy - logp_x - log_qyx).exp(), max=1.0)
+    mask = u < accept_prob
+    mask_p = mask.unsqueeze(-1)
+    return (
+        torch.where(mask_p, proposal_point, point),
+        torch.where(mask, logp_y, logp_x),
+        torch.where(mask_p, grad_y, grad_x),
+        accept_prob,
+        mask,
+    )
+
+
+def fused_mala_transition(
+    point: torch.FloatTensor,
+    logp_x: torch.FloatTensor,
+    grad_x: torch.FloatTensor,
+    target: Union[Distribution, torchDist],
+    project: Callable,
+    step: Union[float, torch.Tensor],
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    MALA transition with N(0, I) noise, latent-space arithmetic runs in
+    compiled kernels, only target evaluation stays eager
+
+    Returns:
+        new points, their log-densities and gradients, acceptance
+        probabilities, accept mask
+    """
+    step = torch.as_tensor(step, dtype=point.dtype, device=point.device)
+    noise = torch.randn_like(point)
+    with torch.no_grad():
+        proposal_point = fused_langevin_step(point, grad_x, noise, step)
+    proposal_point = project(proposal_point).requires_grad_()
+    logp_y, grad_y = log_prob_and_grad(proposal_point, target)
+    with torch.no_grad():
+        return fused_mala_correction(
+            point,
+            proposal_point,
+            logp_x.detach(),
+            logp_y.detach(),
+            grad_x,
+            grad_y,
+            noise,
+            step,
+            torch.rand_like(logp_y),
+        )
+
+
+def is_standard_normal(proposal: Union[Distribution, torchDist]) -> bool:
+    """Whether proposal is N(0, I), so its noise might be drawn by randn"""
+    loc = getattr(proposal, "loc", None)
+    scale_tril = getattr(proposal, "scale_tril", None)
+    if loc is None or scale_tril is None:
+        return False
+    eye = torch.eye(scale_tril.shape[-1], device=scale_tril.device)
+    return bool((loc == 0).all() and (scale_tril == eye).all())
+
+
 @MCMCRegistry.register()
+@collect_chains
 def mala(
     start: torch.FloatTensor,
     target: Union[Distribution, torchDist],
@@ -205,20 +938,39 @@ def mala(
     burn_in: int,
     project: Callable,
     *,
-    step_size: float,
+    step_size: Union[float, torch.Tensor],
     verbose: bool = False,
     target_acceptance=None,
     meta: Optional[Dict] = None,
     keep_graph: bool = False,
-) -> Tuple[torch.FloatTensor, Dict]:
+    per_chain_step_size: bool = False,
+    adapt: str = "heuristic",
+    adapt_steps: Optional[int] = None,
+    preconditioner: Optional[Preconditioner] = None,
+    fused: bool = True,
+) -> KernelStream:
     """
     Metropolis-Adjusted Langevin Algorithm with Normal proposal
 
     Args:
         start - strating points of shape [n_chains x dim]
         target - target distribution instance with method "log_prob"
-        step_size - step size for drift term
+        step_size - step size for drift term, scalar or tensor of shape [n_chains]
         verbose - whether show iterations' bar
+        target_acceptance - desired acceptance rate, no adaptation if not set
+        per_chain_step_size - whether to keep separate step size for each chain
+        adapt - step size adaptation, "heuristic" or "dual_averaging"
+            (per-chain step sizes are always adapted with dual averaging)
+        adapt_steps - number of adaptation iterations counted across calls
+            through meta, burn_in if None, afterwards step size is fixed
+            to the averaged one
+        preconditioner - preconditioner applied to drift, noise and MH
+            correction, updated with new points while adapting
+        fused - whether to use compiled proposal and MH correction (if graph
+            is not kept, there is no preconditioner and proposal is N(0, I))
+        thinning - keep every thinning-th sample after burn-in
+        chain_device - device to store chains on
+        pin_memory - whether to pin chains storage (if stored on CPU)
 
     Returns:
         sequence of slices per each iteration, meta
@@ -226,7 +978,6 @@ def mala(
     if n_samples + burn_in <= 0:
         raise ValueError("Number of steps might be positive")
 
-    chains = []
     point = start.clone()
     point.requires_grad_()
     point.grad = None
@@ -235,59 +986,98 @@ def mala(
     meta["mh_accept"] = meta.get("mh_accept", [])
     meta["step_size"] = meta.get("step_size", [])
 
+    step_size = init_step_size(step_size, point, per_chain_step_size)
+    # adapting kernel does not keep target invariant, so adaptation is
+    # stopped after burn-in by default
+    if adapt_steps is None:
+        adapt_steps = burn_in
+    adapter = None
+    if target_acceptance and (
+        adapt == "dual_averaging"
+        or isinstance(step_size, torch.Tensor)
+        and step_size.ndim > 0
+    ):
+        if "step_size_adapter" not in meta:
+            meta["step_size_adapter"] = DualAveragingStepSize(
+                torch.as_tensor(step_size, device=point.device), target_acceptance
+            )
+        adapter = meta["step_size_adapter"]
+    elif adapt not in ["heuristic", "dual_averaging"]:
+        raise ValueError(f"Unknown step size adaptation {adapt}")
+
     if "grad" not in meta:
-        logp_x = target.log_prob(point)
-        if keep_graph:
-            grad_x = torch.autograd.grad(
-                logp_x.sum(), point, create_graph=keep_graph, retain_graph=keep_graph
-            )[0]
-        else:
-            grad_x = torch.autograd.grad(logp_x.sum(), point)[0].detach()
+        logp_x, grad_x = log_prob_and_grad(point, target, keep_graph)
+        notify_accept(target)
         meta["logp"] = logp_x
         meta["grad"] = grad_x
     logp_x = meta["logp"]
     grad_x = meta["grad"]
+    fused = (
+        fused
+        and not keep_graph
+        and preconditioner is None
+        and is_standard_normal(proposal)
+    )
 
     pbar = trange if verbose else range
     for step_id in pbar(n_samples + burn_in):
-        noise = proposal.sample(point.shape[:-1])
-        proposal_point = point + step_size * grad_x + noise * (2 * step_size) ** 0.5
-        proposal_point = project(proposal_point)
-        if not keep_graph:
-            proposal_point = proposal_point.detach().requires_grad_()
-
-        logp_y = target.log_prob(proposal_point)
-        grad_y = torch.autograd.grad(
-            logp_y.sum(),
-            proposal_point,
-            create_graph=keep_graph,
-            retain_graph=keep_graph,
-        )[
-            0
-        ]  # .detach()
-
-        log_qyx = proposal.log_prob(noise)
-        log_qxy = proposal.log_prob(
-            (point - proposal_point - step_size * grad_y) / (2 * step_size) ** 0.5
-        )
-
-        accept_prob = torch.clamp((logp_y + log_qxy - logp_x - log_qyx).exp(), max=1)
-        mask = torch.rand_like(accept_prob) < accept_prob
-        mask = mask.detach()
-
-        if keep_graph:
-            mask_f = mask.float()
-            point = point * (1 - mask_f)[:, None] + proposal_point * mask_f[:, None]
-            logp_x = logp_x * (1 - mask_f) + logp_y * mask_f
-            grad_x = grad_x * (1 - mask_f)[:, None] + grad_y * mask_f[:, None]
+        step = broadcast_step_size(step_size, point)
+        if fused:
+            point, logp_x, grad_x, accept_prob, mask = fused_mala_transition(
+                point, logp_x, grad_x, target, project, step
+            )
         else:
-            with torch.no_grad():
-                point[mask, :] = proposal_point[mask, :]
-                logp_x[mask] = logp_y[mask]
-                grad_x[mask] = grad_y[mask]
+            if preconditioner is not None:
+                noise = preconditioner.sample(point.shape[:-1], device=point.device)
+                drift_x = preconditioner.mv(grad_x)
+            else:
+                noise = proposal.sample(point.shape[:-1])
+                drift_x = grad_x
+            proposal_point = point + step * drift_x + noise * (2 * step) ** 0.5
+            proposal_point = project(proposal_point)
+            if not keep_graph:
+                proposal_point = proposal_point.detach().requires_grad_()
+
+            logp_y, grad_y = log_prob_and_grad(proposal_point, target, keep_graph)
+
+            if preconditioner is not None:
+                # Gaussian proposal with covariance 2 * step * C
+                log_qyx = -preconditioner.inv_quad(noise) / 2
+                log_qxy = -preconditioner.inv_quad(
+                    (point - proposal_point - step * preconditioner.mv(grad_y))
+                    / (2 * step) ** 0.5
+                ) / 2
+            else:
+                log_qyx = proposal.log_prob(noise)
+                log_qxy = proposal.log_prob(
+                    (point - proposal_point - step * grad_y) / (2 * step) ** 0.5
+                )
+
+            accept_prob = torch.clamp(
+                (logp_y + log_qxy - logp_x - log_qyx).exp(), max=1
+            )
+            mask = torch.rand_like(accept_prob) < accept_prob
+            mask = mask.detach()
+
+            if keep_graph:
+                mask_f = mask.float()
+                point = point * (1 - mask_f)[:, None] + proposal_point * mask_f[:, None]
+                logp_x = logp_x * (1 - mask_f) + logp_y * mask_f
+                grad_x = grad_x * (1 - mask_f)[:, None] + grad_y * mask_f[:, None]
+            else:
+                with torch.no_grad():
+                    point[mask, :] = proposal_point[mask, :]
+                    logp_x[mask] = logp_y[mask]
+                    grad_x[mask] = grad_y[mask]
+        notify_accept(target, mask)
 
         meta["mh_accept"].append(mask.float().mean().item())
-        if target_acceptance:
+        if adapter is not None:
+            if adapter.t < adapt_steps:
+                step_size = adapter.update(accept_prob)
+            else:
+                step_size = adapter.avg_step_size
+        elif target_acceptance:
             step_size = heuristics_step_size(
                 meta["mh_accept"][-1], target_acceptance, step_size
             )
@@ -295,18 +1085,165 @@ def mala(
 
         if not keep_graph:
             point = point.detach().requires_grad_()
-        if step_id >= burn_in:
-            chains.append(point)
-    chains = torch.stack(chains, 0)
+        if preconditioner is not None and preconditioner.adapting:
+            preconditioner.update(point)
+        yield step_id, point, dict(
+            mh_accept=meta["mh_accept"][-1], step_size=meta["step_size"][-1]
+        )
 
     meta["logp"] = logp_x
     meta["grad"] = grad_x
-    meta["mask"] = mask.detach().cpu()
+    meta["mask"] = mask.detach()
+
+    return meta
+
+
+def get_preconditioner(
+    start: torch.FloatTensor,
+    meta: Dict,
+    rank: int,
+    n_warmup: int,
+    buffer_size: int,
+) -> Preconditioner:
+    if "preconditioner" not in meta:
+        meta["preconditioner"] = Preconditioner(
+            start.shape[-1], rank=rank, n_warmup=n_warmup, buffer_size=buffer_size
+        )
+    return meta["preconditioner"]
+
+
+@MCMCRegistry.register()
+@collect_chains
+def pula(
+    start: torch.FloatTensor,
+    target: Union[Distribution, torchDist],
+    proposal: Union[Distribution, torchDist],
+    n_samples: int,
+    burn_in: int,
+    project: Callable,
+    *,
+    step_size: Union[float, torch.Tensor],
+    rank: int = 0,
+    n_warmup: int = 100,
+    buffer_size: int = 4096,
+    verbose: bool = False,
+    meta: Optional[Dict] = None,
+    keep_graph: bool = False,
+) -> KernelStream:
+    """
+    Preconditioned Unadjusted Langevin Algorithm
+
+    Preconditioner is estimated from the first n_warmup iterations
+    (counted across calls) and kept in meta.
+
+    Args:
+        start - strating points of shape [n_chains, dim]
+        target - target distribution instance with method "log_prob"
+        n_samples - number of last samples from each chain to return
+        burn_in - number of first samples from each chain to throw away
+        step_size - step size for drift term, scalar or tensor of shape [n_chains]
+        rank - rank of low-rank part of preconditioner, diagonal if 0
+        n_warmup - number of warm-up iterations to estimate preconditioner
+        buffer_size - number of warm-up samples kept to estimate low-rank part
+        verbose - whether to show iterations' bar
+        thinning - keep every thinning-th sample after burn-in
+        chain_device - device to store chains on
+        pin_memory - whether to pin chains storage (if stored on CPU)
+
+    Returns:
+        tensor of chains with shape [ceil(n_samples / thinning), n_chains, dim]
+    """
+    meta = meta if meta is not None else dict()
+    preconditioner = get_preconditioner(start, meta, rank, n_warmup, buffer_size)
+    return (
+        yield from ula.stream(
+            start,
+            target,
+            proposal,
+            n_samples,
+            burn_in,
+            project,
+            step_size=step_size,
+            verbose=verbose,
+            meta=meta,
+            keep_graph=keep_graph,
+            preconditioner=preconditioner,
+        )
+    )
+
+
+@MCMCRegistry.register()
+@collect_chains
+def pmala(
+    start: torch.FloatTensor,
+    target: Union[Distribution, torchDist],
+    proposal: Union[Distribution, torchDist],
+    n_samples: int,
+    burn_in: int,
+    project: Callable,
+    *,
+    step_size: Union[float, torch.Tensor],
+    rank: int = 0,
+    n_warmup: int = 100,
+    buffer_size: int = 4096,
+    verbose: bool = False,
+    target_acceptance=None,
+    meta: Optional[Dict] = None,
+    keep_graph: bool = False,
+    per_chain_step_size: bool = False,
+    adapt: str = "heuristic",
+    adapt_steps: Optional[int] = None,
+) -> KernelStream:
+    """
+    Preconditioned Metropolis-Adjusted Langevin Algorithm
 
-    return chains, meta
+    Preconditioner is estimated from the first n_warmup iterations
+    (counted across calls) and kept in meta.
+
+    Args:
+        start - strating points of shape [n_chains x dim]
+        target - target distribution instance with method "log_prob"
+        step_size - step size for drift term, scalar or tensor of shape [n_chains]
+        rank - rank of low-rank part of preconditioner, diagonal if 0
+        n_warmup - number of warm-up iterations to estimate preconditioner
+        buffer_size - number of warm-up samples kept to estimate low-rank part
+        verbose - whether show iterations' bar
+        target_acceptance - desired acceptance rate, no adaptation if not set
+        per_chain_step_size - whether to keep separate step size for each chain
+        adapt - step size adaptation, "heuristic" or "dual_averaging"
+        adapt_steps - number of step size adaptation iterations, burn_in if None
+        thinning - keep every thinning-th sample after burn-in
+        chain_device - device to store chains on
+        pin_memory - whether to pin chains storage (if stored on CPU)
+
+    Returns:
+        tensor of chains with shape [ceil(n_samples / thinning), n_chains, dim]
+    """
+    meta = meta if meta is not None else dict()
+    preconditioner = get_preconditioner(start, meta, rank, n_warmup, buffer_size)
+    return (
+        yield from mala.stream(
+            start,
+            target,
+            proposal,
+            n_samples,
+            burn_in,
+            project,
+            step_size=step_size,
+            verbose=verbose,
+            target_acceptance=target_acceptance,
+            meta=meta,
+            keep_graph=keep_graph,
+            per_chain_step_size=per_chain_step_size,
+            adapt=adapt,
+            adapt_steps=adapt_steps,
+            preconditioner=preconditioner,
+        )
+    )
 
 
 @MCMCRegistry.register()
+@collect_chains
 def ex2mcmc(
     start: torch.FloatTensor,
     target: Union[Distribution, torchDist],
@@ -315,15 +1252,20 @@ def ex2mcmc(
     burn_in: int,
     project: Callable,
     *,
-    step_size: float,
+    step_size: Union[float, torch.Tensor],
     n_particles: int,
     n_mala_steps: int = 1,
     target_acceptance: float = False,
     verbose: bool = False,
     meta: Optional[Dict] = None,
     keep_graph: bool = False,
-):
-    chains = []
+    per_chain_step_size: bool = False,
+    adapt: str = "heuristic",
+    adapt_steps: Optional[int] = None,
+    rao_blackwell: bool = False,
+    proposal_stream: str = "iid",
+    proposal_seed: Optional[int] = None,
+) -> KernelStream:
     point = start.clone()
     point.requires_grad_(True)
     point.grad = None
@@ -335,36 +1277,104 @@ def ex2mcmc(
 
     pbar = trange if verbose else range
     for step_id in pbar(n_samples + burn_in):
-        points, meta = isir(
-            point, target, proposal, 1, 0, project, n_particles=n_particles, meta=meta
+        point, meta = last_state(
+            isir.stream(
+                point,
+                target,
+                proposal,
+                1,
+                0,
+                project,
+                n_particles=n_particles,
+                meta=meta,
+                keep_graph=keep_graph,
+                return_grad=not keep_graph,
+                rao_blackwell=rao_blackwell,
+                proposal_stream=proposal_stream,
+                proposal_seed=proposal_seed,
+            )
         )
-        # meta["grad"] = torch.autograd.grad(meta["logp"].sum(), points[-1])[
-        #     0
-        # ]  # .detach()
-        points, meta = mala(
-            points[-1],
-            target,
-            proposal,
-            n_mala_steps,
-            n_mala_steps - 1,
-            project,
-            step_size=step_size,
-            target_acceptance=target_acceptance,
-            meta=meta,
-            keep_graph=keep_graph,
+        point, meta = last_state(
+            mala.stream(
+                point,
+                target,
+                proposal,
+                n_mala_steps,
+                n_mala_steps - 1,
+                project,
+                step_size=step_size,
+                target_acceptance=target_acceptance,
+                meta=meta,
+                keep_graph=keep_graph,
+                per_chain_step_size=per_chain_step_size,
+                adapt=adapt,
+                adapt_steps=adapt_steps,
+            )
         )
         step_size = meta["step_size"][-1]
-        point = points[-1]
         if not keep_graph:
             point = point.detach().requires_grad_()
-        if step_id >= burn_in:
-            chains.append(point)
+        yield step_id, point, dict(
+            sir_accept=meta["sir_accept"][-1],
+            mh_accept=meta["mh_accept"][-1],
+            step_size=step_size,
+        )
 
-    chains = torch.stack(chains, 0)
-    return chains, meta
+    return meta
+
+
+def leapfrog(
+    point: torch.FloatTensor,
+    momentum: torch.FloatTensor,
+    grad: torch.FloatTensor,
+    target: Union[Distribution, torchDist],
+    step_size: Union[float, torch.Tensor],
+    n_steps: int,
+    project: Callable,
+    keep_graph: bool = False,
+) -> Tuple[torch.FloatTensor, torch.FloatTensor, torch.FloatTensor, torch.FloatTensor]:
+    """
+    Leapfrog integrator for Hamiltonian with unit mass matrix, vectorised over chains
+
+    Args:
+        point - positions of shape [n_chains, dim]
+        momentum - momenta of shape [n_chains, dim]
+        grad - gradients of target log-density at point
+        step_size - scalar or broadcastable per-chain (possibly negative) step size
+        n_steps - number of leapfrog steps (>= 1)
+
+    Returns:
+        position, momentum, log-density and its gradient at the end of trajectory
+    """
+    for _ in range(n_steps):
+        momentum = momentum + 0.5 * step_size * grad
+        point = project(point + step_size * momentum)
+        if not keep_graph:
+            point = point.detach().requires_grad_()
+        logp, grad = log_prob_and_grad(point, target, keep_graph)
+        momentum = momentum + 0.5 * step_size * grad
+    return point, momentum, logp, grad
+
+
+def kinetic_energy(momentum: torch.FloatTensor) -> torch.FloatTensor:
+    return 0.5 * momentum.pow(2).sum(-1)
+
+
+def step_size_adapter(
+    step_size: Union[float, torch.Tensor],
+    point: torch.FloatTensor,
+    target_acceptance: float,
+    meta: Dict,
+) -> DualAveragingStepSize:
+    if "step_size_adapter" not in meta:
+        meta["step_size_adapter"] = DualAveragingStepSize(
+            torch.as_tensor(step_size, device=point.device), target_acceptance
+        )
+    return meta["step_size_adapter"]
 
 
 @MCMCRegistry.register()
+@collect_chains
 def hmc(
     start: torch.FloatTensor,
     target: Union[Distribution, torchDist],
@@ -373,47 +1383,631 @@ def hmc(
     burn_in: int,
     project: Callable,
     *,
-    step_size: float,
+    step_size: Union[float, torch.Tensor],
     leapfrog_steps: int = 1,
     target_acceptance: float = False,
     adapt_step_size: bool = False,
+    per_chain_step_size: bool = False,
+    adapt_steps: Optional[int] = None,
     verbose: bool = False,
     meta: Optional[Dict] = None,
-):
+    keep_graph: bool = False,
+) -> KernelStream:
+    """
+    Hamiltonian Monte Carlo with unit mass matrix
+
+    Chains are independent: leapfrog trajectories are vectorised over chains,
+    each chain has its own accept / reject decision (and, optionally,
+    its own step size). Log-density and gradient at the current point are
+    reused between iterations (and between calls through meta).
+
+    Args:
+        start - strating points of shape [n_chains, dim]
+        target - target distribution instance with method "log_prob"
+        n_samples - number of last samples from each chain to return
+        burn_in - number of first samples from each chain to throw away
+        step_size - leapfrog step size, scalar or tensor of shape [n_chains]
+        leapfrog_steps - number of leapfrog steps per iteration
+        target_acceptance - desired acceptance rate for step size adaptation
+        adapt_step_size - whether to adapt step size with dual averaging
+        per_chain_step_size - whether to keep separate step size for each chain
+        adapt_steps - number of adaptation iterations counted across calls
+            through meta, burn_in if None, afterwards step size is fixed
+            to the averaged one
+        verbose - whether to show iterations' bar
+        thinning - keep every thinning-th sample after burn-in
+        chain_device - device to store chains on
+        pin_memory - whether to pin chains storage (if stored on CPU)
+
+    Returns:
+        tensor of chains with shape [ceil(n_samples / thinning), n_chains, dim]
+    """
+    point = start.clone()
+    point.requires_grad_(True)
+    point.grad = None
+
     meta = meta or dict()
+    meta["mh_accept"] = meta.get("mh_accept", [])
     meta["step_size"] = meta.get("step_size", [])
-    if "hmc_kernel" not in meta:
-        kernel = HMC(
-            potential_fn=lambda x: -target.log_prob(x["points"]),
-            full_mass=False,
-            step_size=step_size,
-            num_steps=leapfrog_steps,
-            adapt_step_size=adapt_step_size,
-            target_accept_prob=target_acceptance,
+
+    step_size = init_step_size(step_size, point, per_chain_step_size)
+    # adapting kernel does not keep target invariant, so adaptation is
+    # stopped after burn-in by default
+    if adapt_steps is None:
+        adapt_steps = burn_in
+    adapter = None
+    if adapt_step_size and target_acceptance:
+        adapter = step_size_adapter(step_size, point, target_acceptance, meta)
+
+    if "grad" not in meta:
+        meta["logp"], meta["grad"] = log_prob_and_grad(point, target, keep_graph)
+        notify_accept(target)
+    logp_x = meta["logp"]
+    grad_x = meta["grad"]
+
+    pbar = trange if verbose else range
+    for step_id in pbar(n_samples + burn_in):
+        step = broadcast_step_size(step_size, point)
+        momentum = torch.randn_like(point)
+        energy_x = -logp_x + kinetic_energy(momentum)
+        proposal_point, momentum, logp_y, grad_y = leapfrog(
+            point, momentum, grad_x, target, step, leapfrog_steps, project, keep_graph
         )
-        meta["hmc_kernel"] = kernel
+        energy_y = -logp_y + kinetic_energy(momentum)
 
-    x = start.clone()
-    x.requires_grad_(False)
-    x.grad = None
+        accept_prob = torch.clamp((energy_x - energy_y).exp(), max=1)
+        accept_prob = torch.nan_to_num(accept_prob.detach(), nan=0.0)
+        mask = torch.rand_like(accept_prob) < accept_prob
+
+        if keep_graph:
+            mask_f = mask.float()
+            point = point * (1 - mask_f)[:, None] + proposal_point * mask_f[:, None]
+            logp_x = logp_x * (1 - mask_f) + logp_y * mask_f
+            grad_x = grad_x * (1 - mask_f)[:, None] + grad_y * mask_f[:, None]
+        else:
+            point = torch.where(mask[:, None], proposal_point, point)
+            logp_x = torch.where(mask, logp_y, logp_x)
+            grad_x = torch.where(mask[:, None], grad_y, grad_x)
+        notify_accept(target, mask)
+
+        meta["mh_accept"].append(mask.float().mean().item())
+        if adapter is not None:
+            if adapter.t < adapt_steps:
+                step_size = adapter.update(accept_prob)
+            else:
+                step_size = adapter.avg_step_size
+        meta["step_size"].append(step_size)
 
-    init_params = {"points": x}
-    mcmc = MCMC(
-        kernel=meta["hmc_kernel"],
-        num_samples=n_samples,
-        initial_params=init_params,
-        warmup_steps=burn_in,
+        if not keep_graph:
+            point = point.detach().requires_grad_()
+        yield step_id, point, dict(
+            mh_accept=meta["mh_accept"][-1], step_size=meta["step_size"][-1]
+        )
+
+    meta["logp"] = logp_x
+    meta["grad"] = grad_x
+    meta["mask"] = mask.detach()
+
+    return meta
+
+
+def no_u_turn(
+    left: torch.FloatTensor,
+    right: torch.FloatTensor,
+    momentum_left: torch.FloatTensor,
+    momentum_right: torch.FloatTensor,
+) -> torch.BoolTensor:
+    """Whether trajectory from left to right end has not made a U-turn yet"""
+    diff = right - left
+    return ((diff * momentum_left).sum(-1) >= 0) & (
+        (diff * momentum_right).sum(-1) >= 0
     )
-    mcmc.run()
-    meta["step_size"].append(meta["hmc_kernel"].step_size)
 
-    chains = mcmc.get_samples(group_by_chain=True)["points"]
-    chains = chains.view(-1, *start.shape)
 
-    return chains, meta
+@MCMCRegistry.register()
+@collect_chains
+def nuts(
+    start: torch.FloatTensor,
+    target: Union[Distribution, torchDist],
+    proposal: Union[Distribution, torchDist],
+    n_samples: int,
+    burn_in: int,
+    project: Callable,
+    *,
+    step_size: Union[float, torch.Tensor],
+    max_tree_depth: int = 6,
+    max_delta_energy: float = 1000.0,
+    target_acceptance: float = False,
+    adapt_step_size: bool = False,
+    per_chain_step_size: bool = False,
+    adapt_steps: Optional[int] = None,
+    verbose: bool = False,
+    meta: Optional[Dict] = None,
+    keep_graph: bool = False,
+) -> KernelStream:
+    """
+    No-U-Turn Sampler with multinomial sampling of trajectory points
+
+    Each chain builds its own tree (own directions, own stopping and own
+    divergence checks). Trees are doubled synchronously: at each doubling
+    all chains which are still running make the same number of leapfrog
+    steps, subtrees' U-turn criteria are checked iteratively by keeping
+    the leftmost state of each not yet finished subtree level. At the end
+    of each call the target is evaluated at the selected samples once more,
+    so its per-chain state (e.g. MaxEnt features) describes them.
+
+    Args:
+        start - strating points of shape [n_chains, dim]
+        target - target distribution instance with method "log_prob"
+        n_samples - number of last samples from each chain to return
+        burn_in - number of first samples from each chain to throw away
+        step_size - leapfrog step size, scalar or tensor of shape [n_chains]
+        max_tree_depth - maximal number of tree doublings
+        max_delta_energy - energy error after which trajectory is divergent
+        target_acceptance - desired acceptance statistic for step size adaptation
+        adapt_step_size - whether to adapt step size with dual averaging
+        per_chain_step_size - whether to keep separate step size for each chain
+        adapt_steps - number of adaptation iterations counted across calls
+            through meta, burn_in if None, afterwards step size is fixed
+            to the averaged one
+        verbose - whether to show iterations' bar
+        thinning - keep every thinning-th sample after burn-in
+        chain_device - device to store chains on
+        pin_memory - whether to pin chains storage (if stored on CPU)
+
+    Returns:
+        tensor of chains with shape [ceil(n_samples / thinning), n_chains, dim]
+    """
+    if keep_graph:
+        raise ValueError("NUTS does not support keep_graph")
+
+    point = start.clone().detach().requires_grad_()
+
+    meta = meta or dict()
+    meta["mh_accept"] = meta.get("mh_accept", [])
+    meta["step_size"] = meta.get("step_size", [])
+    meta["tree_depth"] = meta.get("tree_depth", [])
+
+    step_size = init_step_size(step_size, point, per_chain_step_size)
+    # adapting kernel does not keep target invariant, so adaptation is
+    # stopped after burn-in by default
+    if adapt_steps is None:
+        adapt_steps = burn_in
+    adapter = None
+    if adapt_step_size and target_acceptance:
+        adapter = step_size_adapter(step_size, point, target_acceptance, meta)
+
+    if "grad" not in meta:
+        meta["logp"], meta["grad"] = log_prob_and_grad(point, target)
+    logp_x = meta["logp"]
+    grad_x = meta["grad"]
+
+    n_chains = point.shape[0]
+    pbar = trange if verbose else range
+    for step_id in pbar(n_samples + burn_in):
+        step = broadcast_step_size(step_size, point)
+        momentum = torch.randn_like(point)
+        energy_0 = -logp_x + kinetic_energy(momentum)
+
+        # trajectory ends and the current sample of each chain
+        x_left, p_left, g_left = point, momentum, grad_x
+        x_right, p_right, g_right = point, momentum, grad_x
+        sample, logp_sample, grad_sample = point, logp_x, grad_x
+        log_weight = -energy_0
+        running = torch.ones(n_chains, dtype=torch.bool, device=point.device)
+        depth = torch.zeros(n_chains, device=point.device)
+        accept_stat = torch.zeros(n_chains, device=point.device)
+        n_leaves = torch.zeros(n_chains, device=point.device)
+
+        for tree_depth in range(max_tree_depth):
+            direction = (
+                torch.randint(
+                    0, 2, (n_chains, 1), dtype=point.dtype, device=point.device
+                )
+                * 2
+                - 1
+            )
+            forward = direction[:, 0] > 0
+            x = torch.where(forward[:, None], x_right, x_left)
+            p = torch.where(forward[:, None], p_right, p_left)
+            g = torch.where(forward[:, None], g_right, g_left)
+
+            valid = running.clone()
+            sub_log_weight = torch.full_like(log_weight, -float("inf"))
+            sub_sample, sub_logp, sub_grad = x, logp_x, g
+            subtree_starts = dict()
+            for leaf_id in range(2**tree_depth):
+                x, p, logp, g = leapfrog(x, p, g, target, direction * step, 1, project)
+                energy = -logp + kinetic_energy(p)
+                energy = torch.nan_to_num(energy, nan=float("inf"))
+                valid &= energy - energy_0 <= max_delta_energy
+
+                accept_stat += (
+                    torch.clamp((energy_0 - energy).exp(), max=1) * running.float()
+                )
+                n_leaves += running.float()
+
+                # multinomial sampling inside subtree
+                leaf_log_weight = -energy
+                new_log_weight = torch.logaddexp(sub_log_weight, leaf_log_weight)
+                take = valid & (
+                    torch.rand_like(energy).log() < leaf_log_weight - new_log_weight
+                )
+                sub_log_weight = torch.where(valid, new_log_weight, sub_log_weight)
+                sub_sample = torch.where(take[:, None], x, sub_sample)
+                sub_logp = torch.where(take, logp, sub_logp)
+                sub_grad = torch.where(take[:, None], g, sub_grad)
+
+                # U-turn checks of subtrees ending at this leaf
+                for level in range(1, tree_depth + 1):
+                    if leaf_id % 2**level == 0:
+                        subtree_starts[level] = (x, p)
+                    elif (leaf_id + 1) % 2**level == 0:
+                        x_start, p_start = subtree_starts[level]
+                        valid &= no_u_turn(
+                            direction * x_start, direction * x, p_start, p
+                        )
+                if not valid.any():
+                    break
+
+            # merge subtree into trajectory, biased progressive sampling
+            take = valid & (
+                torch.rand_like(log_weight).log() < sub_log_weight - log_weight
+            )
+            sample = torch.where(take[:, None], sub_sample, sample)
+            logp_sample = torch.where(take, sub_logp, logp_sample)
+            grad_sample = torch.where(take[:, None], sub_grad, grad_sample)
+            log_weight = torch.where(
+                valid, torch.logaddexp(log_weight, sub_log_weight), log_weight
+            )
+
+            extend_right = (valid & forward)[:, None]
+            extend_left = (valid & ~forward)[:, None]
+            x_right = torch.where(extend_right, x, x_right)
+            p_right = torch.where(extend_right, p, p_right)
+            g_right = torch.where(extend_right, g, g_right)
+            x_left = torch.where(extend_left, x, x_left)
+            p_left = torch.where(extend_left, p, p_left)
+            g_left = torch.where(extend_left, g, g_left)
+
+            depth += running.float()
+            running = valid & no_u_turn(x_left, x_right, p_left, p_right)
+            if not running.any():
+                break
+
+        mask = (sample != point).any(-1)
+        point = sample.detach().requires_grad_()
+        logp_x, grad_x = logp_sample, grad_sample
+        accept_prob = accept_stat / n_leaves.clamp(min=1)
+
+        meta["mh_accept"].append(accept_prob.mean().item())
+        meta["tree_depth"].append(depth.mean().item())
+        if adapter is not None:
+            if adapter.t < adapt_steps:
+                step_size = adapter.update(accept_prob)
+            else:
+                step_size = adapter.avg_step_size
+        meta["step_size"].append(step_size)
+
+        yield step_id, point, dict(
+            mh_accept=meta["mh_accept"][-1],
+            step_size=meta["step_size"][-1],
+            tree_depth=meta["tree_depth"][-1],
+        )
+
+    meta["logp"] = logp_x
+    meta["grad"] = grad_x
+    meta["mask"] = mask.detach()
+    # the last evaluated points are leaves of the trajectory rather than
+    # selected samples, target state (e.g. features) is evaluated at samples
+    if hasattr(target, "accept"):
+        with torch.no_grad():
+            target.log_prob(point.detach())
+        notify_accept(target)
+
+    return meta
+
+
+def adapt_ladder(betas: torch.Tensor, rejection: torch.Tensor) -> torch.Tensor:
+    """
+    Moves inverse temperatures so that swap rejection rates between
+    neighbouring temperatures become equal (Syed et al., 2021)
+
+    Args:
+        betas - decreasing inverse temperatures of shape [n_temperatures]
+        rejection - estimated rejection rates of neighbouring pairs' swaps
+
+    Returns:
+        new inverse temperatures with the same endpoints
+    """
+    rejection = rejection.detach().cpu().double().numpy()
+    # communication barrier, strictly increasing for interpolation
+    barrier = np.concatenate([[0.0], np.cumsum(rejection)])
+    barrier += np.arange(len(barrier)) * 1e-8
+    targets = np.linspace(0, barrier[-1], len(barrier))
+    new_betas = np.interp(targets, barrier, betas.detach().cpu().double().numpy())
+    return torch.tensor(new_betas, dtype=betas.dtype, device=betas.device)
+
+
+def tempered_log_prob_and_grad(
+    point: torch.FloatTensor,
+    target: Union[Distribution, torchDist],
+    proposal: Union[Distribution, torchDist],
+) -> Tuple[torch.FloatTensor, ...]:
+    """
+    Log-likelihood part log p(z) - log p0(z) of target, prior part log p0(z)
+    (p0 is proposal) and their gradients, target is called once
+    """
+    point = point.detach().requires_grad_()
+    logp, grad = log_prob_and_grad(point, target)
+    logp0 = proposal.log_prob(point)
+    if logp0.requires_grad:
+        grad0 = torch.autograd.grad(logp0.sum(), point)[0]
+    else:
+        grad0 = torch.zeros_like(point)
+    logp, logp0 = logp.detach(), logp0.detach()
+    return logp - logp0, grad - grad0, logp0, grad0
+
+
+# chains' axis of meta values which do not have a leading chains' dimension,
+# None for values shared by all chains (e.g. temperature ladder)
+META_CHAIN_AXIS: Dict[str, Optional[int]] = dict(
+    replicas=1,
+    betas=None,
+    replica_step_size=None,
+    swap_rejection=None,
+)
+
+
+@MCMCRegistry.register()
+@collect_chains
+def replica_exchange(
+    start: torch.FloatTensor,
+    target: Union[Distribution, torchDist],
+    proposal: Union[Distribution, torchDist],
+    n_samples: int,
+    burn_in: int,
+    project: Callable,
+    *,
+    step_size: Union[float, torch.Tensor],
+    n_temperatures: int = 4,
+    min_beta: float = 0.1,
+    swap_every: int = 1,
+    adapt_ladder_every: Optional[int] = 10,
+    target_acceptance: Optional[float] = None,
+    verbose: bool = False,
+    meta: Optional[Dict] = None,
+    keep_graph: bool = False,
+) -> KernelStream:
+    """
+    Replica exchange (parallel tempering) with MALA moves
+
+    Replica at inverse temperature beta targets
+    p0(z) * (p(z) / p0(z)) ** beta, p0 is proposal (prior). Temperatures are
+    folded into the batch dimension, so each MALA step makes a single target
+    call for all replicas. Swaps between neighbouring temperatures are
+    proposed for all chains at once (alternating even and odd pairs),
+    the ladder is adapted to equalise swap rejection rates. Replicas, ladder
+    and step sizes are kept in meta between calls, only cold chains
+    (beta = 1) are returned. At the end of each call the target is evaluated
+    on cold chains once more, so its per-chain state (e.g. MaxEnt features)
+    describes cold chains only.
+
+    Args:
+        start - strating points of shape [n_chains, dim]
+        target - target distribution instance with method "log_prob"
+        proposal - prior distribution with method "log_prob"
+        n_samples - number of last samples from each chain to return
+        burn_in - number of first samples from each chain to throw away
+        step_size - MALA step size of the cold chain, scalar or tensor
+            of shape [n_temperatures]
+        n_temperatures - number of temperatures
+        min_beta - inverse temperature of the hottest replica
+        swap_every - propose swaps every swap_every iterations
+        adapt_ladder_every - adapt ladder every adapt_ladder_every swaps,
+            ladder is fixed if None
+        target_acceptance - desired MALA acceptance rate of each temperature,
+            step sizes are adapted with dual averaging if set
+        verbose - whether to show iterations' bar
+        thinning - keep every thinning-th sample after burn-in
+        chain_device - device to store chains on
+        pin_memory - whether to pin chains storage (if stored on CPU)
+
+    Returns:
+        tensor of cold chains with shape [ceil(n_samples / thinning), n_chains, dim]
+    """
+    if keep_graph:
+        raise ValueError("Replica exchange does not support keep_graph")
+
+    meta = meta or dict()
+    meta["mh_accept"] = meta.get("mh_accept", [])
+    meta["swap_accept"] = meta.get("swap_accept", [])
+    meta["step_size"] = meta.get("step_size", [])
+    n_chains = start.shape[0]
+    device = start.device
+
+    if "replicas" not in meta or meta["replicas"].shape[1] != n_chains:
+        betas = torch.tensor(
+            np.geomspace(1.0, min_beta, n_temperatures),
+            dtype=torch.float,
+            device=device,
+        )
+        if isinstance(step_size, torch.Tensor) and step_size.ndim > 0:
+            steps = step_size.to(device).float()
+        else:
+            # hotter replicas are flatter, start them with larger steps
+            steps = float(step_size) / betas
+        meta["replicas"] = start.detach().repeat(n_temperatures, 1, 1)
+        meta["betas"] = betas
+        meta["replica_step_size"] = steps
+        meta["swap_rejection"] = torch.zeros(n_temperatures - 1, device=device)
+        meta["swap_count"] = 0
+    replicas = meta["replicas"]
+    replicas[0] = start.detach()
+    betas = meta["betas"]
+    steps = meta["replica_step_size"]
+
+    adapter = None
+    if target_acceptance:
+        adapter = step_size_adapter(steps, start, target_acceptance, meta)
+
+    point = replicas.reshape(-1, start.shape[-1])
+    loglik, grad_loglik, logp0, grad_logp0 = tempered_log_prob_and_grad(
+        point, target, proposal
+    )
+
+    pbar = trange if verbose else range
+    for step_id in pbar(n_samples + burn_in):
+        beta = betas.repeat_interleave(n_chains)
+        step = steps.repeat_interleave(n_chains)[:, None]
+        logp_x = logp0 + beta * loglik
+        grad_x = grad_logp0 + beta[:, None] * grad_loglik
+
+        noise = torch.randn_like(point)
+        proposal_point = project(point + step * grad_x + noise * (2 * step) ** 0.5)
+        loglik_y, grad_loglik_y, logp0_y, grad_logp0_y = tempered_log_prob_and_grad(
+            proposal_point, target, proposal
+        )
+        logp_y = logp0_y + beta * loglik_y
+        grad_y = grad_logp0_y + beta[:, None] * grad_loglik_y
+
+        log_qyx = -(noise ** 2).sum(-1) / 2
+        log_qxy = -(
+            ((point - proposal_point - step * grad_y) / (2 * step) ** 0.5) ** 2
+        ).sum(-1) / 2
+        accept_prob = torch.clamp((logp_y + log_qxy - logp_x - log_qyx).exp(), max=1)
+        accept_prob = torch.nan_to_num(accept_prob, nan=0.0)
+        mask = torch.rand_like(accept_prob) < accept_prob
+
+        point = torch.where(mask[:, None], proposal_point.detach(), point)
+        loglik = torch.where(mask, loglik_y, loglik)
+        grad_loglik = torch.where(mask[:, None], grad_loglik_y, grad_loglik)
+        logp0 = torch.where(mask, logp0_y, logp0)
+        grad_logp0 = torch.where(mask[:, None], grad_logp0_y, grad_logp0)
+
+        meta["mh_accept"].append(mask[:n_chains].float().mean().item())
+        if adapter is not None:
+            steps = adapter.update(accept_prob.view(n_temperatures, -1).mean(1))
+
+        if n_temperatures > 1 and (step_id + 1) % swap_every == 0:
+            # even and odd neighbouring pairs are swapped in turns
+            lower = torch.arange(meta["swap_count"] % 2, n_temperatures - 1, 2)
+            upper = lower + 1
+            loglik_t = loglik.view(n_temperatures, n_chains)
+            log_swap = (betas[lower] - betas[upper])[:, None] * (
+                loglik_t[upper] - loglik_t[lower]
+            )
+            swap_prob = torch.clamp(log_swap.exp(), max=1)
+            swap = torch.rand_like(swap_prob) < swap_prob
+
+            perm = torch.arange(n_temperatures * n_chains, device=device)
+            perm = perm.view(n_temperatures, n_chains)
+            perm_lower = perm[lower].clone()
+            perm[lower] = torch.where(swap, perm[upper], perm[lower])
+            perm[upper] = torch.where(swap, perm_lower, perm[upper])
+            perm = perm.reshape(-1)
+            point, loglik, grad_loglik = point[perm], loglik[perm], grad_loglik[perm]
+            logp0, grad_logp0 = logp0[perm], grad_logp0[perm]
+
+            meta["swap_rejection"][lower] += 1 - swap_prob.mean(1)
+            meta["swap_count"] += 1
+            meta["swap_accept"].append(swap.float().mean().item())
+            if (
+                adapt_ladder_every is not None
+                and meta["swap_count"] % (2 * adapt_ladder_every) == 0
+            ):
+                rejection = meta["swap_rejection"] / adapt_ladder_every
+                betas = adapt_ladder(betas, rejection)
+                meta["betas"] = betas
+                meta["swap_rejection"].zero_()
+
+        meta["step_size"].append(steps[0])
+        meta["replica_step_size"] = steps
+        cold = point[:n_chains].detach().requires_grad_()
+        yield step_id, cold, dict(
+            mh_accept=meta["mh_accept"][-1], step_size=meta["step_size"][-1]
+        )
+
+    meta["replicas"] = point.detach().view(n_temperatures, n_chains, -1)
+    meta["logp"] = (logp0 + loglik)[:n_chains]
+    # target state (e.g. features) has to describe cold chains only, swaps
+    # reorder replicas after their last evaluation, so cold chains are evaluated
+    if hasattr(target, "accept"):
+        with torch.no_grad():
+            target.log_prob(point[:n_chains].detach())
+        notify_accept(target)
+    meta["mask"] = torch.ones(n_chains, dtype=torch.bool, device=device)
+
+    return meta
+
+
+class ReplayBuffer:
+    """
+    Fixed-capacity device-resident buffer of points and their log-densities
+
+    Storage is allocated once on the first insert, inserts take time
+    independent of the number of stored points.
+
+    Args:
+        capacity - maximal number of stored points
+        mode - "fifo" (ring buffer, the oldest points are overwritten) or
+            "reservoir" (uniform sample of all points ever inserted)
+    """
+
+    def __init__(self, capacity: int, mode: str = "fifo"):
+        if mode not in ["fifo", "reservoir"]:
+            raise ValueError(f"Unknown replay buffer mode {mode}")
+        self.capacity = capacity
+        self.mode = mode
+        self.points: Optional[torch.Tensor] = None
+        self.log_ps: Optional[torch.Tensor] = None
+        self.n_seen = 0
+        self.size = 0
+
+    def __len__(self) -> int:
+        return self.size
+
+    def to(self, device: Union[str, int, torch.device]) -> "ReplayBuffer":
+        if self.points is not None:
+            self.points = self.points.to(device)
+            self.log_ps = self.log_ps.to(device)
+        return self
+
+    @torch.no_grad()
+    def push(self, points: torch.Tensor, log_ps: torch.Tensor):
+        if self.points is None:
+            self.points = torch.empty(
+                (self.capacity, *points.shape[1:]),
+                dtype=points.dtype,
+                device=points.device,
+            )
+            self.log_ps = torch.empty(
+                self.capacity, dtype=log_ps.dtype, device=log_ps.device
+            )
+
+        ids = self.n_seen + torch.arange(points.shape[0], device=points.device)
+        if self.mode == "fifo":
+            points, log_ps = points[-self.capacity :], log_ps[-self.capacity :]
+            slots = ids[-self.capacity :] % self.capacity
+        else:
+            # point number i replaces a random slot with probability capacity / (i + 1)
+            replace = (torch.rand_like(ids, dtype=torch.float) * (ids + 1)).long()
+            slots = torch.where(ids < self.capacity, ids, replace)
+            keep = slots < self.capacity
+            points, log_ps, slots = points[keep], log_ps[keep], slots[keep]
+
+        self.points[slots] = points.detach()
+        self.log_ps[slots] = log_ps.detach()
+        self.n_seen += ids.shape[0]
+        self.size = min(self.n_seen, self.capacity)
+
+    def sample(self, n: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        idxs = torch.randint(0, self.size, (n,), device=self.points.device)
+        return self.points[idxs], self.log_ps[idxs]
 
 
 @MCMCRegistry.register()
+@collect_chains
 def flex2mcmc(
     start: torch.FloatTensor,
     target,
@@ -428,13 +2022,15 @@ def flex2mcmc(
     step_size: float,
     n_mala_steps: int = 1,
     add_pop_size_train: int = 4096,
+    buffer_size: int = 65536,
+    buffer_mode: str = "fifo",
     forward_kl_weight: float = 1.0,
     backward_kl_weight: float = 1.0,
     target_acceptance: float = False,
     verbose: bool = False,
     meta: Optional[Dict] = None,
     keep_graph: bool = False,
-) -> Tuple[torch.FloatTensor, Dict]:
+) -> KernelStream:
     """
     Ex2MCMC with Flow proposal
 
@@ -447,13 +2043,19 @@ def flex2mcmc(
         step_size - step size for drift term
         n_particles - number of particles including one from previous step
         n_mala_steps - number of MALA steps after each SIR step
+        add_pop_size_train - number of past proposals added to forward KL estimate
+        buffer_size - capacity of past proposals' buffer, kept in
+            meta["replay_buffer"] between calls
+        buffer_mode - "fifo" or "reservoir" replacement in past proposals' buffer
         verbose - whether to show iterations' bar
+        thinning - keep every thinning-th sample after burn-in
+        chain_device - device to store chains on
+        pin_memory - whether to pin chains storage (if stored on CPU)
 
     Returns:
-        tensor of chains with shape [n_samples, n_chains, dim],
+        tensor of chains with shape [ceil(n_samples / thinning), n_chains, dim],
           acceptance rates for each iteration
     """
-    chains = []
     if meta:
         meta["sir_accept"] = meta.get("sir_accept", [])
         meta["forward_kl"] = meta.get("forward_kl", [])
@@ -465,45 +2067,62 @@ def flex2mcmc(
     x.requires_grad_(True)
     x.grad = None
 
-    hist_proposals = None
+    # past proposals are kept in meta, so they are reused between calls
+    history = meta.get("replay_buffer")
+    if (
+        history is None
+        or history.capacity != buffer_size
+        or history.mode != buffer_mode
+    ):
+        history = ReplayBuffer(buffer_size, buffer_mode)
+    meta["replay_buffer"] = history.to(x.device)
 
     pbar = trange(n_samples + burn_in) if verbose else range(n_samples + burn_in)
     for step_id in pbar:
-        x, proposals, log_ps, _, indices = isir_step(
-            x, target, proposal, n_particles=n_particles
-        )
-        meta["sir_accept"].append((indices != 0).float().mean().item())
-        x, meta = mala(
+        x, proposals, log_ps, _, indices, grads = isir_step(
             x,
             target,
-            proposal.prior,
-            n_mala_steps,
-            n_mala_steps - 1,
-            project,
-            step_size=step_size,
-            target_acceptance=target_acceptance,
-            verbose=False,
-            meta=meta,
+            proposal,
+            n_particles=n_particles,
+            logp_x=meta.get("logp"),
+            grad_x=meta.get("grad"),
+            return_grad=True,
         )
-        step_size = meta["step_size"]
-        x = x[-1]
-
-        if step_id >= burn_in:
-            chains.append(x)
+        meta["logp"] = log_ps[np.arange(x.shape[0]), indices].detach()
+        meta["grad"] = grads[np.arange(x.shape[0]), indices]
+        notify_accept(target, F.one_hot(indices, num_classes=n_particles).bool())
+        x = x.detach().requires_grad_()
+        meta["sir_accept"].append((indices != 0).float().mean().item())
+        x, meta = last_state(
+            mala.stream(
+                x,
+                target,
+                proposal.prior,
+                n_mala_steps,
+                n_mala_steps - 1,
+                project,
+                step_size=step_size,
+                target_acceptance=target_acceptance,
+                verbose=False,
+                meta=meta,
+            )
+        )
+        step_size = meta["step_size"][-1]
+        meta_delta = dict(sir_accept=meta["sir_accept"][-1])
         # else:
         if proposal.optim.param_groups[0]["lr"] > 0:
             # forward KL
-            proposals_flattened = proposals.reshape(-1, x.shape[-1])
-            log_ps_flattened = log_ps.reshape(-1).detach()
+            new_proposals = proposals.reshape(-1, x.shape[-1])
+            new_log_ps = log_ps.reshape(-1).detach()
+            proposals_flattened = new_proposals
+            log_ps_flattened = new_log_ps
 
-            if hist_proposals is not None:
-                idxs = np.random.choice(hist_proposals.shape[0], add_pop_size_train)
+            if len(history) > 0:
+                hist_proposals, hist_log_ps = history.sample(add_pop_size_train)
                 proposals_flattened = torch.cat(
-                    (proposals_flattened, hist_proposals[idxs]), dim=0
-                )
-                log_ps_flattened = torch.cat(
-                    (log_ps_flattened, hist_log_ps[idxs]), dim=0
+                    (proposals_flattened, hist_proposals), dim=0
                 )
+                log_ps_flattened = torch.cat((log_ps_flattened, hist_log_ps), dim=0)
 
             log_qs = proposal.log_prob(proposals_flattened)
             logw = log_ps_flattened - log_qs.detach()
@@ -525,6 +2144,9 @@ def flex2mcmc(
 
             meta["forward_kl"].append(kl_forw.item())
             meta["backward_kl"].append(kl_back.item())
+            meta_delta.update(
+                forward_kl=meta["forward_kl"][-1], backward_kl=meta["backward_kl"][-1]
+            )
 
             if verbose:
                 pbar.set_description(
@@ -536,11 +2158,7 @@ def flex2mcmc(
                     KL back {kl_back.item():.3f} Hentr {e.item():.3f}"
             )
 
-            if hist_proposals is None:
-                hist_proposals = proposals_flattened
-                hist_log_ps = log_ps_flattened
-            else:
-                hist_proposals = torch.cat((hist_proposals, proposals_flattened), dim=0)
-                hist_log_ps = torch.cat((hist_log_ps, log_ps_flattened), dim=0)
-    chains = torch.stack(chains, 0)
-    return chains, meta
+            history.push(new_proposals, new_log_ps)
+
+        yield step_id, x, meta_delta
+    return meta
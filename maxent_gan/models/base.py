@@ -1,4 +1,6 @@
-from typing import Optional, Tuple
+import weakref
+from collections import OrderedDict
+from typing import Hashable, Optional, Tuple
 
 import torch
 from torch import nn
@@ -87,22 +89,81 @@ class BaseGenerator(nn.Module):
         return self.label.data.long()
 
 
-class MemoryModel(nn.Module):
-    def __init__(self, module: nn.Module):
+class CachedModel(nn.Module):
+    """
+    Wrapper keeping a small LRU cache of module outputs for recent inputs
+
+    Inputs are identified by storage pointer, version counter, shape, strides,
+    dtype and requires_grad flag (or by an explicit cache token) together with
+    grad mode and version counters of module parameters, so no elementwise
+    comparison is made, and in-place changes of inputs or parameters
+    invalidate entries. Outputs are cached with their autograd graph, so
+    targets, features and callbacks evaluated on the same batch share one
+    forward. A graph does not outlive backward through it, so caches are
+    dropped with clear_cache after each sampling step.
+
+    Args:
+        module - wrapped module
+        max_size - maximal number of cached outputs
+    """
+
+    instances: weakref.WeakSet = weakref.WeakSet()
+
+    def __init__(self, module: nn.Module, max_size: int = 4):
         super().__init__()
         self.module = module
-        self.input = None
-        self.output = None
+        self.max_size = max_size
+        self.cache: OrderedDict = OrderedDict()
+        self.instances.add(self)
+
+    @staticmethod
+    def tensor_key(tensor: torch.Tensor) -> Tuple:
+        # requires_grad_() does not bump the version, outputs computed
+        # without graph must not be returned to calls expecting one
+        return (
+            tensor.data_ptr(),
+            tensor._version,
+            tuple(tensor.shape),
+            tensor.stride(),
+            tensor.dtype,
+            tensor.device,
+            tensor.requires_grad,
+            torch.is_grad_enabled(),
+        )
 
-    def forward(self, input):
-        if self.input is not None and torch.equal(self.input, input):
-            output = self.output
-        else:
-            output = self.module.forward(input)
-            self.output = output
-            self.input = input
+    def key(self, input: torch.Tensor, cache_token: Optional[Hashable]) -> Tuple:
+        label = getattr(self, "label", None)
+        return (
+            self.tensor_key(input)
+            if cache_token is None
+            else (cache_token, input.requires_grad, torch.is_grad_enabled()),
+            self.tensor_key(label) if isinstance(label, torch.Tensor) else id(label),
+            self.training,
+            sum(param._version for param in self.module.parameters()),
+        )
+
+    def forward(self, input, cache_token: Optional[Hashable] = None):
+        key = self.key(input, cache_token)
+        if key in self.cache:
+            self.cache.move_to_end(key)
+            return self.cache[key][1]
+        output = self.module.forward(input)
+        if isinstance(output, torch.Tensor):
+            # input is kept alive, so its storage pointer cannot be reused
+            self.cache[key] = (input, output)
+            if len(self.cache) > self.max_size:
+                self.cache.popitem(last=False)
         return output
 
+    def clear(self):
+        self.cache.clear()
+
+    @classmethod
+    def clear_cache(cls):
+        """Drops cached outputs of all instances, called after each sampling step"""
+        for model in list(cls.instances):
+            model.clear()
+
 
 # class LogitNormalization(nn.Module):
 #     def __init__(self):
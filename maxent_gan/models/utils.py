@@ -7,7 +7,7 @@ from tqdm import trange
 
 from maxent_gan.utils.general_utils import ROOT_DIR, DotConfig
 
-from .base import MemoryModel, ModelRegistry
+from .base import CachedModel, ModelRegistry
 
 
 def init_weights(m):
@@ -68,8 +68,8 @@ class GANWrapper:
         self.dp = config.dp
 
         if eval:
-            self.gen = MemoryModel(self.gen)
-            self.dis = MemoryModel(self.dis)
+            self.gen = CachedModel(self.gen)
+            self.dis = CachedModel(self.dis)
 
         dis_attrs = ["transform", "output_layer", "label", "penult_layer"]
         self.dis.__dict__.update(
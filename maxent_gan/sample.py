@@ -1,17 +1,34 @@
 import copy
-from typing import Dict, Iterable, List, Optional, Tuple, Union
+import numbers
+import os
+import socket
+import traceback
+from pathlib import Path
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple, Union
 
+import numpy as np
 import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
 from scipy.optimize import minimize  # noqa: F401
 from torch import nn
 from torch.distributions import Distribution as torchDist
 from tqdm import trange
 
 from maxent_gan.distribution import Distribution, MaxEntTarget
-from maxent_gan.feature import BaseFeature
-from maxent_gan.mcmc import MCMCRegistry
+from maxent_gan.feature import BaseFeature, EmbeddingRegistry
+from maxent_gan.mcmc import META_CHAIN_AXIS, MCMCRegistry
+from maxent_gan.models.base import CachedModel
 from maxent_gan.utils import time_comp_cls
+from maxent_gan.utils.general_utils import (
+    get_rng_state,
+    random_seed,
+    save_atomic,
+    set_rng_state,
+    to_device,
+)
 from maxent_gan.utils.callbacks import Callback
+from maxent_gan.utils.diagnostics import OnlineDiagnostics
 
 
 class MaxEntSampler:
@@ -38,7 +55,24 @@ class MaxEntSampler:
         mcmc_args: Optional[Dict] = None,
         callbacks: Optional[Iterable[Callback]] = None,
         keep_graph: bool = False,
+        diagnose_every: Optional[int] = None,
+        rhat_threshold: Optional[float] = None,
+        ess_threshold: Optional[float] = None,
+        on_converged: str = "stop",
     ):
+        """
+        Args:
+            diagnose_every - compute online convergence diagnostics
+                (split-R-hat, ESS, ESS per second, energy and feature residual
+                autocorrelations) every diagnose_every iterations after burn-in,
+                no diagnostics if None
+            rhat_threshold - chains are converged when split-R-hat is below it
+            ess_threshold - chains are converged when ESS is above it
+            on_converged - "stop" sampling or "stop_saving" states once
+                chains are converged
+        """
+        if on_converged not in ["stop", "stop_saving"]:
+            raise ValueError(f"Unknown on_converged action {on_converged}")
         self.gen = gen
         self._ref_dist = ref_dist
         self.feature = feature
@@ -56,6 +90,14 @@ class MaxEntSampler:
         self.collect_imgs = collect_imgs
         self.callbacks = callbacks or []
         self.keep_graph = keep_graph
+        self.meta: Dict = dict()
+        self.diagnose_every = diagnose_every
+        self.rhat_threshold = rhat_threshold
+        self.ess_threshold = ess_threshold
+        self.on_converged = on_converged
+        self.diagnostics = OnlineDiagnostics()
+        self.diagnostics_summary: Dict[str, float] = dict()
+        self.estimates: Dict[str, float] = dict()
 
         self.sampling = sampling
         self.init_mcmc_args: Dict = copy.deepcopy(mcmc_args or dict())
@@ -72,6 +114,8 @@ class MaxEntSampler:
 
     def reset(self):
         self.mcmc_args = copy.deepcopy(self.init_mcmc_args)
+        self.diagnostics.reset()
+        self.diagnostics_summary = dict()
         for callback in self.callbacks:
             callback.reset()
 
@@ -79,6 +123,42 @@ class MaxEntSampler:
     def ref_dist(self):
         return self._ref_dist
 
+    def state_dict(self) -> Dict:
+        """
+        Complete sampler state: MCMC arguments (adapted step sizes), kernel meta,
+        feature weights with optimizer state and averages, diagnostics and RNG
+        """
+        return dict(
+            mcmc_args=self.mcmc_args,
+            meta=self.meta,
+            feature=self.feature.state_dict(),
+            diagnostics=self.diagnostics,
+            diagnostics_summary=self.diagnostics_summary,
+            rng=get_rng_state(),
+        )
+
+    def load_state_dict(self, state: Dict):
+        """
+        Restores state saved by state_dict, which has to be loaded on CPU,
+        so that RNG states stay on CPU, chains' state is moved to the device
+        """
+        device = self.target.device
+        self.mcmc_args = to_device(state["mcmc_args"], device)
+        self.meta = to_device(state["meta"], device)
+        self.feature.load_state_dict(to_device(state["feature"], device))
+        self.diagnostics = to_device(state["diagnostics"], device)
+        self.diagnostics_summary = state["diagnostics_summary"]
+        set_rng_state(state["rng"])
+
+    def save_checkpoint(
+        self, path: Union[str, Path], z: torch.Tensor, it: int, **extra
+    ):
+        """
+        Atomically writes sampler state together with current chains' state z
+        at iteration it (and any extra picklable values) to path
+        """
+        save_atomic(dict(sampler=self.state_dict(), z=z, it=it, **extra), path)
+
     def step(
         self,
         z: torch.Tensor,
@@ -116,52 +196,153 @@ class MaxEntSampler:
             keep_graph=keep_graph,
         )
 
+        # outputs and embeddings are shared within one step only
+        CachedModel.clear_cache()
+        EmbeddingRegistry.clear_cache()
         self.mcmc_args.update(
             {key: meta[key][-1] for key in self.mcmc_args.keys() & meta.keys()}
         )
-        self.feature.average_feature(meta["mask"])
+        if meta.get("rb_feature"):
+            # importance weighted estimates over all particles
+            for estimate in meta.pop("rb_feature"):
+                self.feature.avg_feature.upd(estimate, weight=len(z))
+        else:
+            self.feature.average_feature()
+        if meta.get("rb_energy"):
+            self.estimates["rb_energy"] = float(np.mean(meta.pop("rb_energy")))
+        if dist.is_available() and dist.is_initialized():
+            # chains are sharded across processes, keep weight updates consistent
+            self.feature.avg_feature.all_reduce(z.shape[0])
 
         return pts[-1], meta
 
-    @time_comp_cls
-    def __call__(
+    def diagnose(self, z: torch.Tensor, it: int, meta: Dict) -> bool:
+        """
+        Updates online diagnostics with the current state,
+        returns whether chains are converged
+        """
+        if self.diagnose_every is None or it <= self.burn_in_steps:
+            return False
+
+        logp = meta.get("logp")
+        energy = None
+        if isinstance(logp, torch.Tensor) and logp.shape == z.shape[:1]:
+            energy = -logp.detach()
+        residual = torch.cat(
+            [
+                torch.as_tensor(x, dtype=torch.float).detach().to(z.device).reshape(-1)
+                for x in self.feature.avg_feature.data
+            ]
+        ).norm()
+        self.diagnostics.update(z, energy, residual)
+        if it % self.diagnose_every != 0:
+            return False
+
+        self.diagnostics_summary = self.diagnostics.summary()
+        if self.rhat_threshold is None and self.ess_threshold is None:
+            return False
+        converged = (
+            self.rhat_threshold is None
+            or self.diagnostics_summary["rhat"] <= self.rhat_threshold
+        ) and (
+            self.ess_threshold is None
+            or self.diagnostics_summary["ess"] >= self.ess_threshold
+        )
+        if dist.is_available() and dist.is_initialized():
+            # all shards have to stop at the same iteration
+            flag = torch.tensor(float(converged))
+            dist.all_reduce(flag, op=dist.ReduceOp.MIN)
+            converged = bool(flag.item())
+        return converged
+
+    def stream(
         self,
         z: torch.Tensor,
         n_steps: Optional[int] = None,
         data_batch: Optional[torch.FloatTensor] = None,
         collect_imgs: bool = False,
         keep_graph: bool = False,
-    ) -> Tuple[List, List, List, List]:
+        start_it: int = 0,
+    ) -> Iterator[Tuple[int, torch.Tensor, Optional[torch.Tensor]]]:
+        """
+        Runs sampling and yields (it, z, x) for the starting point (it = 0)
+        and for each saved iteration, x is None if images are not collected.
+        If start_it > 0, sampling is resumed after iteration start_it from
+        state z with sampler state restored by load_state_dict.
+        States are yielded on CPU as soon as they are produced, so they can be
+        saved or evaluated without materialising whole chains.
+        Sampling (or saving) stops early once chains are converged
+        if convergence thresholds are set.
+        """
         n_steps = n_steps if n_steps is not None else self.n_steps
         collect_imgs = collect_imgs or self.collect_imgs
         keep_graph = keep_graph or self.keep_graph
-        zs = [z.cpu()]
-        xs = []
-        meta = dict()
-        if collect_imgs:
-            xs.append(self.gen.inverse_transform(self.gen(z)).detach().cpu())
+        save = True
         self.target.radnic_logps = []
         self.target.ref_logps = []
+        if start_it == 0:
+            meta = dict()
+            self.meta = meta
+            self.diagnostics.reset()
+            self.diagnostics_summary = dict()
+
+            yield 0, z.cpu(), self.generate(z) if collect_imgs else None
+
+            self.feature.avg_feature.reset()
+            # outputs of chain states are tracked from the new starting points
+            self.feature.reset_output()
+        else:
+            meta = self.meta
 
         it = 0
-        self.feature.avg_feature.reset()
-        for it in self.trange(1, n_steps + 1):
+        for it in self.trange(start_it + 1, n_steps + 1):
             new_z, meta = self.step(z, it, data_batch, meta=meta, keep_graph=keep_graph)
+            self.meta = meta
             if it > self.start_sample:
                 z = new_z
+            converged = self.diagnose(z.detach(), it, meta)
 
-            if it > self.burn_in_steps and it % self.save_every == 0:
-                if keep_graph:
-                    zs.append(z.cpu())
-                else:
-                    zs.append(z.detach().cpu())
-                if collect_imgs:
-                    xs.append(
-                        self.gen.inverse_transform(self.gen(z.detach())).detach().cpu()
-                    )
+            if save and it > self.burn_in_steps and it % self.save_every == 0:
+                yield (
+                    it,
+                    z.cpu() if keep_graph else z.detach().cpu(),
+                    self.generate(z.detach()) if collect_imgs else None,
+                )
 
             for callback in self.callbacks:
-                callback.invoke(self.mcmc_args)
+                callback.invoke(
+                    dict(self.mcmc_args, **self.diagnostics_summary, **self.estimates)
+                    if self.diagnostics_summary or self.estimates
+                    else self.mcmc_args
+                )
+
+            if converged and save:
+                if self.verbose:
+                    print(f"Converged at iteration {it}: {self.diagnostics_summary}")
+                if self.on_converged == "stop":
+                    break
+                save = False
+
+    def generate(self, z: torch.Tensor) -> torch.Tensor:
+        return self.gen.inverse_transform(self.gen(z)).detach().cpu()
+
+    @time_comp_cls
+    def __call__(
+        self,
+        z: torch.Tensor,
+        n_steps: Optional[int] = None,
+        data_batch: Optional[torch.FloatTensor] = None,
+        collect_imgs: bool = False,
+        keep_graph: bool = False,
+    ) -> Tuple[List, List, List, List]:
+        zs = []
+        xs = []
+        for _, z, x in self.stream(z, n_steps, data_batch, collect_imgs, keep_graph):
+            zs.append(z)
+            if x is not None:
+                xs.append(x)
+        if self.verbose and self.diagnostics_summary:
+            print("Diagnostics:", self.diagnostics_summary)
 
         # self.target.log_prob(z.detach(), data_batch) ??
 
@@ -218,3 +399,280 @@ class MaxEntSampler:
     #     print(weights)
     #     self.feature.weights = weights
     #     return weights
+
+
+def to_numpy(values: Dict) -> Dict:
+    """Picklable copy of tensors and lists of numbers from values"""
+    result = dict()
+    for key, value in values.items():
+        if isinstance(value, torch.Tensor):
+            result[key] = value.detach().cpu().numpy()
+        elif isinstance(value, numbers.Number):
+            result[key] = value
+        elif isinstance(value, list) and all(
+            isinstance(v, numbers.Number) for v in value
+        ):
+            result[key] = value
+    return result
+
+
+def chain_axis(key: str, value: np.ndarray, n_chains: int) -> Optional[int]:
+    """Chains' axis of value in a shard of n_chains chains, None if shared"""
+    if key in META_CHAIN_AXIS:
+        return META_CHAIN_AXIS[key]
+    if value.ndim > 0 and value.shape[0] == n_chains:
+        return 0
+    return None
+
+
+def merge_shards(shards: List[Dict], n_chains: List[int]) -> Dict:
+    """
+    Merges per-shard values: per-chain arrays are concatenated along chains'
+    dimension, other arrays, scalars and lists of scalars (per-iteration
+    statistics) are averaged, arrays of mismatching shapes are kept from
+    the first shard
+    """
+    merged = dict()
+    for key in shards[0]:
+        pairs = [(shard[key], n) for shard, n in zip(shards, n_chains) if key in shard]
+        values = [value for value, _ in pairs]
+        if isinstance(values[0], np.ndarray):
+            axes = {chain_axis(key, value, n) for value, n in pairs}
+            if len(axes) == 1 and None not in axes:
+                merged[key] = torch.from_numpy(np.concatenate(values, axes.pop()))
+            elif all(value.shape == values[0].shape for value in values):
+                merged[key] = torch.from_numpy(np.asarray(np.mean(values, axis=0)))
+            else:
+                merged[key] = torch.from_numpy(values[0])
+        elif isinstance(values[0], list):
+            merged[key] = np.mean(values, axis=0).tolist()
+        elif all(value == values[0] for value in values):
+            merged[key] = values[0]
+        else:
+            merged[key] = float(np.mean(values))
+    return merged
+
+
+def take_shard(values: Dict, shard: torch.Tensor, n_chains: int) -> Dict:
+    """Slices tensors with a value per chain, other values are kept as is"""
+    result = dict()
+    for key, value in values.items():
+        per_chain = isinstance(value, torch.Tensor) and value.ndim > 0
+        if per_chain and len(value) == n_chains:
+            value = value[shard.to(value.device)]
+        result[key] = value
+    return result
+
+
+def shard_worker(
+    rank: int,
+    world_size: int,
+    init_method: str,
+    sampler: MaxEntSampler,
+    z: torch.Tensor,
+    n_steps: Optional[int],
+    data_batch: Optional[torch.Tensor],
+    collect_imgs: bool,
+    start_it: int,
+    gan: Any,
+    n_threads: int,
+    seed: int,
+    queue: mp.Queue,
+    done: mp.Event,
+):
+    torch.set_num_threads(n_threads)
+    random_seed(seed + rank)
+    dist.init_process_group(
+        "gloo", init_method=init_method, rank=rank, world_size=world_size
+    )
+    shard = torch.tensor_split(torch.arange(len(z)), world_size)[rank]
+    if gan is not None and isinstance(gan.label, torch.Tensor):
+        gan.set_label(gan.label[shard.to(gan.label.device)])
+    if data_batch is not None:
+        data_batch = data_batch[shard.to(data_batch.device)]
+    if start_it > 0:
+        # per-chain state of resumed sampling is sharded along with chains
+        sampler.meta = take_shard(sampler.meta, shard, len(z))
+        sampler.mcmc_args = take_shard(sampler.mcmc_args, shard, len(z))
+    if rank != 0:
+        # logging is done by the first worker only
+        sampler.callbacks = []
+        sampler.verbose = False
+        sampler.trange = range
+    try:
+        for it, z_it, x_it in sampler.stream(
+            z[shard.to(z.device)],
+            n_steps,
+            data_batch,
+            collect_imgs,
+            start_it=start_it,
+        ):
+            queue.put(
+                (rank, it, z_it.numpy(), None if x_it is None else x_it.numpy())
+            )
+        weight = [w.detach().cpu().numpy() for w in sampler.feature.weight]
+        queue.put(
+            (rank, None, (to_numpy(sampler.mcmc_args), to_numpy(sampler.meta)), weight)
+        )
+    except Exception:
+        queue.put((rank, -1, traceback.format_exc(), None))
+    finally:
+        dist.destroy_process_group()
+    done.wait()
+
+
+class ShardedMaxEntSampler:
+    """
+    Runs MaxEntSampler with chains split across CPU worker processes
+
+    Each worker gets a forked copy of the sampler (generator, feature and
+    target included) and samples its shard of chains with the chosen kernel.
+    Feature averages are all-reduced in MaxEntSampler.step, so MaxEnt weights
+    stay the same in all workers. Chains, mcmc_args, meta and final feature
+    weights are merged back into the wrapped sampler.
+
+    Args:
+        sampler - sampler to run
+        n_workers - number of worker processes
+        gan - GANWrapper, its labels (if set) are sharded along with chains
+        n_threads - intra-op threads per worker, cpu_count // n_workers by default
+        seed - random seed, worker i is seeded with seed + i, if not set,
+            base seed is drawn from the parent's RNG on each call
+    """
+
+    def __init__(
+        self,
+        sampler: MaxEntSampler,
+        n_workers: int,
+        *,
+        gan: Any = None,
+        n_threads: Optional[int] = None,
+        seed: Optional[int] = None,
+    ):
+        self.sampler = sampler
+        self.n_workers = n_workers
+        self.gan = gan
+        self.n_threads = n_threads or max(1, (os.cpu_count() or 1) // n_workers)
+        self.seed = seed
+        self.verbose = sampler.verbose
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self.__dict__["sampler"], name)
+
+    def reset(self):
+        self.sampler.reset()
+
+    @staticmethod
+    def init_method() -> str:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+            sock.bind(("127.0.0.1", 0))
+            port = sock.getsockname()[1]
+        return f"tcp://127.0.0.1:{port}"
+
+    def stream(
+        self,
+        z: torch.Tensor,
+        n_steps: Optional[int] = None,
+        data_batch: Optional[torch.FloatTensor] = None,
+        collect_imgs: bool = False,
+        start_it: int = 0,
+    ) -> Iterator[Tuple[int, torch.Tensor, Optional[torch.Tensor]]]:
+        """
+        Same as MaxEntSampler.stream, states are yielded as soon as
+        all workers have produced them. If start_it > 0, workers resume
+        from the state loaded into the wrapped sampler.
+        """
+        if z.is_cuda:
+            raise ValueError("Sharded sampling is supported on CPU only")
+        n_workers = min(self.n_workers, len(z))
+        # forked workers inherit parent's RNG state, so they are always reseeded
+        seed = self.seed
+        if seed is None:
+            seed = int(torch.randint(2 ** 31 - n_workers, ()).item())
+        ctx = mp.get_context("fork")
+        queue = ctx.Queue()
+        done = ctx.Event()
+        init_method = self.init_method()
+        workers = [
+            ctx.Process(
+                target=shard_worker,
+                args=(
+                    rank,
+                    n_workers,
+                    init_method,
+                    self.sampler,
+                    z,
+                    n_steps,
+                    data_batch,
+                    collect_imgs,
+                    start_it,
+                    self.gan,
+                    self.n_threads,
+                    seed,
+                    queue,
+                    done,
+                ),
+                daemon=True,
+            )
+            for rank in range(n_workers)
+        ]
+        for worker in workers:
+            worker.start()
+
+        pending: Dict[int, Dict[int, Tuple]] = dict()
+        results: Dict[int, Tuple] = dict()
+        try:
+            while len(results) < n_workers:
+                rank, it, z_it, x_it = queue.get()
+                if it == -1:
+                    raise RuntimeError(f"Sampling worker {rank} failed:\n{z_it}")
+                if it is None:
+                    results[rank] = (z_it, x_it)
+                    continue
+                pending.setdefault(it, dict())[rank] = (z_it, x_it)
+                if len(pending[it]) == n_workers:
+                    shards = [pending.pop(it)[r] for r in range(n_workers)]
+                    yield (
+                        it,
+                        torch.from_numpy(np.concatenate([s[0] for s in shards])),
+                        None
+                        if shards[0][1] is None
+                        else torch.from_numpy(np.concatenate([s[1] for s in shards])),
+                    )
+        finally:
+            done.set()
+            for worker in workers:
+                worker.join(timeout=10)
+                if worker.is_alive():
+                    worker.terminate()
+
+        n_chains = [len(shard) for shard in torch.tensor_split(z, n_workers)]
+        mcmc_args = merge_shards(
+            [results[r][0][0] for r in range(n_workers)], n_chains
+        )
+        self.sampler.mcmc_args.update(
+            {key: mcmc_args[key] for key in self.sampler.mcmc_args.keys() & mcmc_args}
+        )
+        self.sampler.meta = merge_shards(
+            [results[r][0][1] for r in range(n_workers)], n_chains
+        )
+        with torch.no_grad():
+            for w, w_new in zip(self.sampler.feature.weight, results[0][1]):
+                w.copy_(torch.from_numpy(w_new))
+
+    @time_comp_cls
+    def __call__(
+        self,
+        z: torch.Tensor,
+        n_steps: Optional[int] = None,
+        data_batch: Optional[torch.FloatTensor] = None,
+        collect_imgs: bool = False,
+    ) -> Tuple[List, List, List, List]:
+        zs = []
+        xs = []
+        for _, z, x in self.stream(z, n_steps, data_batch, collect_imgs):
+            zs.append(z)
+            if x is not None:
+                xs.append(x)
+
+        return zs, xs, [], []
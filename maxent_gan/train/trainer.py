@@ -1,7 +1,9 @@
-from typing import Iterable, Optional, Tuple
+from collections import deque
+from typing import Dict, Iterable, Optional, Tuple, Union
 
 import numpy as np
-import torch  # noqa: F401
+import torch
+from torch import nn
 from torch.optim import Optimizer
 from torch.utils.data import DataLoader
 from tqdm import tqdm
@@ -11,6 +13,61 @@ from maxent_gan.train.loss import Loss, gradient_penalty
 from maxent_gan.utils.callbacks import Callback
 
 
+class LatentPool:
+    """
+    Persistent chains for training (as in PCD): fixed-size device-resident
+    bank of latents, each batch continues short chains from stored states
+    instead of burning in from the prior
+
+    Args:
+        prior - latent prior with method "sample"
+        size - number of stored chains
+        refresh_prob - probability to restart a drawn chain from the prior
+        device - device to keep the bank on
+        batch_size - maximal number of chains drawn at once, not more than size
+    """
+
+    def __init__(
+        self, prior, size: int, refresh_prob: float, device, batch_size: int = 1
+    ):
+        if size < batch_size:
+            raise ValueError(
+                f"Latent pool size {size} is less than batch size {batch_size}"
+            )
+        self.prior = prior
+        self.size = size
+        self.refresh_prob = refresh_prob
+        self.device = device
+        self.latents = prior.sample((size,)).detach().to(device)
+        # optional per-chain MCMC state, e.g. number of steps made by each chain
+        self.meta: Dict[str, torch.Tensor] = dict(
+            n_steps=torch.zeros(size, dtype=torch.long, device=device)
+        )
+
+    def sample(self, batch_size: int) -> Tuple[torch.Tensor, torch.LongTensor]:
+        """Draws batch_size distinct chains, returns their states and ids"""
+        ids = torch.randperm(self.size, device=self.device)[:batch_size]
+        latent = self.latents[ids]
+        refresh = torch.rand(len(ids), device=self.device) < self.refresh_prob
+        latent = torch.where(
+            refresh[:, None], self.prior.sample((len(ids),)).to(self.device), latent
+        )
+        for value in self.meta.values():
+            value[ids[refresh]] = 0
+        return latent, ids
+
+    @torch.no_grad()
+    def update(
+        self,
+        ids: torch.LongTensor,
+        latent: torch.Tensor,
+        n_steps: Union[int, torch.LongTensor],
+    ):
+        """Stores new states of chains ids moved by n_steps MCMC steps"""
+        self.latents[ids] = latent.detach().to(self.device)
+        self.meta["n_steps"][ids] += n_steps
+
+
 class Trainer:
     def __init__(
         self,
@@ -35,6 +92,8 @@ class Trainer:
         replay_prob: float = 0.0,
         replay_size: int = 0,
         meta_rate: float = 0.0,
+        fused_dis: bool = False,
+        track_grad_norm: bool = True,
         # clip_grad_norm: float = float('inf'),
         **kwargs,
     ):
@@ -59,7 +118,25 @@ class Trainer:
         self.start_iter = start_iter
         self.eval_every = eval_every
         self.meta_rate = meta_rate
-        self.replay_buffer = []
+        self.latent_pool = (
+            LatentPool(
+                gan.gen.prior,
+                self.replay_size,
+                1.0 - self.replay_prob,
+                device,
+                dataloader.batch_size or 1,
+            )
+            if self.replay_size > 0
+            else None
+        )
+        self.fused_dis = fused_dis
+        self.track_grad_norm = track_grad_norm
+        # batch statistics would mix real and fake batches in one forward,
+        # labels of conditional dis are set per batch and would be misaligned
+        self.dis_fusable = not getattr(gan.dis, "cond", False) and not any(
+            isinstance(module, nn.modules.batchnorm._BatchNorm)
+            for module in gan.dis.modules()
+        )
 
     def freeze_gen(self):
         for p in self.gan.gen.parameters():
@@ -78,19 +155,89 @@ class Trainer:
             p.requires_grad_(True)
 
     @staticmethod
-    def compute_grad_norm(model):
-        total_norm = 0
-        parameters = [
-            p for p in model.parameters() if p.grad is not None and p.requires_grad
+    def compute_grad_norm(model) -> torch.Tensor:
+        """Total gradient norm as a device tensor, without host syncs"""
+        grads = [
+            p.grad.detach()
+            for p in model.parameters()
+            if p.grad is not None and p.requires_grad
         ]
-        for p in parameters:
-            param_norm = p.grad.detach().data.norm(2)
-            total_norm += param_norm.item() ** 2
-        total_norm = total_norm ** 0.5
-        return total_norm
-
-    def step(self, real_batch) -> Tuple[float, ...]:
-        prior = self.gan.gen.prior
+        if len(grads) == 0:
+            return torch.zeros(())
+        foreach_norm = getattr(torch, "_foreach_norm", None)
+        if foreach_norm is not None:
+            norms = foreach_norm(grads)
+        else:
+            norms = [torch.norm(grad, 2) for grad in grads]
+        return torch.norm(torch.stack(norms), 2)
+
+    def is_logged(self, step: int) -> bool:
+        """Whether statistics of step are used by evaluation or any callback"""
+        return step % self.eval_every == 0 or any(
+            step % getattr(callback, "invoke_every", 1) == 0
+            for callback in self.callbacks
+        )
+
+    def sample_latent(self, batch_size: int) -> torch.Tensor:
+        """
+        Draws latents for a training step: starting points (from prior or from
+        the latent pool) are moved by the sampler with probability meta_rate
+
+        Args:
+            batch_size - number of latents
+
+        Returns:
+            latents on self.device
+        """
+        if self.latent_pool is not None:
+            latent, ids = self.latent_pool.sample(batch_size)
+        else:
+            latent = self.gan.gen.prior.sample((batch_size,))
+        latent = latent.to(self.device)
+        # only latents which are replaced are passed to the sampler
+        select_ids = torch.nonzero(torch.rand(batch_size) < self.meta_rate)[:, 0]
+        n_steps = torch.zeros(batch_size, dtype=torch.long, device=self.device)
+        if len(select_ids) > 0:
+            select_ids = select_ids.to(self.device)
+            # the last state is the one made after it sampler iterations
+            for it, z_it, _ in self.sampler.stream(latent[select_ids]):
+                pass
+            latent = latent.clone()
+            latent[select_ids] = z_it.to(self.device)
+            n_steps[select_ids] = it * self.sampler.n_sampling_steps
+        if self.latent_pool is not None:
+            self.latent_pool.update(ids, latent, n_steps)
+        return latent
+
+    def dis_scores(
+        self, fake_batch: torch.Tensor, real_batch: torch.Tensor
+    ) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        Discriminator scores of fake and real batches. If fused_dis is set,
+        both batches go through one forward (unless dis has batch
+        normalisation or is conditional)
+
+        Args:
+            fake_batch - generated images
+            real_batch - real images
+
+        Returns:
+            fake scores, real scores
+        """
+        if self.fused_dis and self.dis_fusable:
+            scores = self.gan.dis(torch.cat([fake_batch, real_batch])).squeeze()
+            return scores[: len(fake_batch)], scores[len(fake_batch) :]
+        score_fake = self.gan.dis(fake_batch).squeeze()
+        return score_fake, self.gan.dis(real_batch).squeeze()
+
+    def step(self, real_batch) -> Tuple[torch.Tensor, ...]:
+        """
+        One training iteration, statistics are returned as device tensors
+
+        Returns:
+            generator loss, discriminator loss, discriminator and generator
+            gradient norms (zeros if grad norms are not tracked)
+        """
         d_batch = real_batch
         batch_size = d_batch.shape[0]
 
@@ -100,28 +247,9 @@ class Trainer:
         loss_d_num = 0
         grad_norm_d_num = 0
         for step_id in range(1, self.n_dis * self.grad_acc_steps + 1):
-            latent = prior.sample((batch_size,))
-
-            # if random.random() < self.replay_prob and len(self.replay_buffer) > 0:
-            #     latent = self.replay_buffer.pop(random.randint(0, len(self.replay_buffer)-1))
-
-            latents, _, _, _ = self.sampler(latent)
-            drop_mask = (
-                (torch.rand(batch_size) < self.meta_rate)
-                .to(self.device)
-                .float()[:, None]
-            )
-            latent = (1.0 - drop_mask) * latent + drop_mask * latents[-1].to(
-                self.device
-            )
-
-            # self.replay_buffer.append(latent.detach().cpu())
-            # if len(self.replay_buffer) > self.replay_size:
-            #     self.replay_buffer.pop(random.randint(0, len(self.replay_buffer)-1))
-
+            latent = self.sample_latent(batch_size)
             fake_batch = self.gan.gen(latent.to(self.device))
-            score_fake = self.gan.dis(fake_batch).squeeze()
-            score_real = self.gan.dis(d_batch).squeeze()
+            score_fake, score_real = self.dis_scores(fake_batch, d_batch)
 
             loss_d = self.criterion_d(score_fake, score_real)
             if self.gp_coef > 0:
@@ -130,10 +258,11 @@ class Trainer:
                 )
             loss_d /= self.grad_acc_steps
             loss_d.backward()
-            loss_d_num += loss_d.item()
-            grad_norm_d_num += (
-                self.compute_grad_norm(self.gan.dis) / self.grad_acc_steps
-            )
+            loss_d_num += loss_d.detach()
+            if self.track_grad_norm:
+                grad_norm_d_num += (
+                    self.compute_grad_norm(self.gan.dis) / self.grad_acc_steps
+                )
             # torch.nn.utils.clip_grad_norm_(self.gan.dis.parameters(), self.clip_grad_norm)
             if step_id % self.grad_acc_steps == 0:
                 self.optimizer_d.step()
@@ -145,26 +274,7 @@ class Trainer:
         loss_g_num = 0
         grad_norm_g_num = 0
         for step_id in range(1, self.n_gen * self.grad_acc_steps + 1):
-            latent = prior.sample((batch_size,))
-
-            # if random.random() < self.replay_prob and len(self.replay_buffer) > 0:
-            #     latent = self.replay_buffer.pop(random.randint(0, len(self.replay_buffer)-1))
-
-            latents, _, _, _ = self.sampler(latent)
-            # latent = latents[-1]
-            drop_mask = (
-                (torch.rand(batch_size) < self.meta_rate)
-                .to(self.device)
-                .float()[:, None]
-            )
-            latent = (1.0 - drop_mask) * latent + drop_mask * latents[-1].to(
-                self.device
-            )
-
-            # self.replay_buffer.append(latent.detach().cpu())
-            # if len(self.replay_buffer) > self.replay_size:
-            #     self.replay_buffer.pop(random.randint(0, len(self.replay_buffer)-1))
-
+            latent = self.sample_latent(batch_size)
             fake_batch = self.gan.gen(latent.to(self.device))
             score_fake = self.gan.dis(fake_batch).squeeze()
 
@@ -172,21 +282,26 @@ class Trainer:
             loss_g /= self.grad_acc_steps
 
             loss_g.backward()
-            loss_g_num += loss_g.item()
-            grad_norm_g_num += (
-                self.compute_grad_norm(self.gan.gen) / self.grad_acc_steps
-            )
+            loss_g_num += loss_g.detach()
+            if self.track_grad_norm:
+                grad_norm_g_num += (
+                    self.compute_grad_norm(self.gan.gen) / self.grad_acc_steps
+                )
             # torch.nn.utils.clip_grad_norm_(self.gan.gen.parameters(), self.clip_grad_norm)
             if step_id % self.grad_acc_steps == 0:
                 self.optimizer_g.step()
                 self.optimizer_g.zero_grad()
 
-        return loss_g_num, loss_d_num, grad_norm_d_num, grad_norm_g_num
+        return tuple(
+            torch.as_tensor(value, dtype=torch.float, device=self.device)
+            for value in [loss_g_num, loss_d_num, grad_norm_d_num, grad_norm_g_num]
+        )
 
     def train(self):
         self.gan.dis.train()
         self.gan.gen.train()
-        loss_g, loss_d = [], []
+        # running losses are kept on device and materialised only when logged
+        loss_g, loss_d = deque(maxlen=self.eval_every), deque(maxlen=self.eval_every)
         for batch_id, batch in tqdm(
             enumerate(self.dataloader, 1), total=len(self.dataloader)
         ):
@@ -194,17 +309,23 @@ class Trainer:
                 continue
             batch = batch.to(self.device)
             l_g, l_d, grad_norm_d, grad_norm_g = self.step(batch)
-            loss_g = loss_g[-self.eval_every + 1 :] + [l_g]
-            loss_d = loss_d[-self.eval_every + 1 :] + [l_d]
-
-            info = dict(
-                step=batch_id,
-                total=len(self.dataloader),
-                loss_g=np.mean(loss_g),
-                loss_d=np.mean(loss_d),
-                grad_norm_d=grad_norm_d,
-                grad_norm_g=grad_norm_g,
-            )
+            loss_g.append(l_g)
+            loss_d.append(l_d)
+
+            info = dict(step=batch_id, total=len(self.dataloader))
+            if self.is_logged(batch_id):
+                # one host sync for all statistics
+                stats = torch.stack(
+                    [
+                        torch.stack(list(loss_g)).mean(),
+                        torch.stack(list(loss_d)).mean(),
+                        grad_norm_d,
+                        grad_norm_g,
+                    ]
+                ).tolist()
+                info.update(loss_g=stats[0], loss_d=stats[1])
+                if self.track_grad_norm:
+                    info.update(grad_norm_d=stats[2], grad_norm_g=stats[3])
 
             if batch_id % self.eval_every == 0:
                 self.gan.gen.eval()
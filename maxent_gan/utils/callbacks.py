@@ -301,8 +301,12 @@ class LogCallback(Callback):
                     save_path = Path(save_dir, f"{key}_{step}.pdf")
                     self.plot(info[key], save_path)
                 else:
+                    value = info[key]
+                    if isinstance(value, torch.Tensor):
+                        # per-chain values (e.g. step sizes) are logged averaged
+                        value = value.float().mean().item()
                     with save_path.open("ab") as f:
-                        np.savetxt(f, [info[key]], delimiter=" ", newline=" ")
+                        np.savetxt(f, [value], delimiter=" ", newline=" ")
         self.cnt += 1
         return 1
 
@@ -0,0 +1,212 @@
+import time
+from collections import deque
+from typing import Dict, Optional, Union
+
+import numpy as np
+import torch
+
+
+class BatchMeans:
+    """
+    Streaming batch statistics of per-chain traces
+
+    Keeps at most max_batches batch sums (and sums of squares) for each chain
+    and each dimension, when all batches are filled, neighbouring batches are
+    merged and batch size is doubled. Memory does not depend on chain length.
+    Statistics are kept on the device of the chains, so updates do not
+    synchronise with the host.
+
+    Args:
+        max_batches - maximal number of stored batches (even)
+    """
+
+    def __init__(self, max_batches: int = 64):
+        self.max_batches = max_batches - max_batches % 2
+        self.batch_size = 1
+        self.n_full = 0
+        self.sums: Optional[torch.Tensor] = None
+        self.sq_sums: Optional[torch.Tensor] = None
+        self.cur_sum: Optional[torch.Tensor] = None
+        self.cur_sq_sum: Optional[torch.Tensor] = None
+        self.cur_cnt = 0
+
+    @torch.no_grad()
+    def update(self, x: torch.Tensor):
+        """x - values of shape [n_chains, dim]"""
+        x = x.detach().double()
+        if self.sums is None:
+            self.sums = x.new_zeros((self.max_batches, *x.shape))
+            self.sq_sums = torch.zeros_like(self.sums)
+            self.cur_sum = torch.zeros_like(x)
+            self.cur_sq_sum = torch.zeros_like(x)
+
+        self.cur_sum += x
+        self.cur_sq_sum += x ** 2
+        self.cur_cnt += 1
+        if self.cur_cnt < self.batch_size:
+            return
+
+        self.sums[self.n_full] = self.cur_sum
+        self.sq_sums[self.n_full] = self.cur_sq_sum
+        self.n_full += 1
+        self.cur_sum.zero_()
+        self.cur_sq_sum.zero_()
+        self.cur_cnt = 0
+        if self.n_full == self.max_batches:
+            half = self.max_batches // 2
+            self.sums[:half] = self.sums[0::2] + self.sums[1::2]
+            self.sq_sums[:half] = self.sq_sums[0::2] + self.sq_sums[1::2]
+            self.n_full = half
+            self.batch_size *= 2
+
+    def to(self, device: Union[str, int, torch.device]) -> "BatchMeans":
+        for name in ["sums", "sq_sums", "cur_sum", "cur_sq_sum"]:
+            if getattr(self, name) is not None:
+                setattr(self, name, getattr(self, name).to(device))
+        return self
+
+    @property
+    def n_samples(self) -> int:
+        """Number of samples per chain in full batches"""
+        return self.n_full * self.batch_size
+
+    def split_rhat(self) -> float:
+        """Split-R-hat (Gelman et al., 2013), maximum over dimensions"""
+        n_half = self.n_full // 2
+        if n_half < 2:
+            return float("nan")
+        start = self.n_full - 2 * n_half
+        sums = self.sums[start : self.n_full]
+        sq_sums = self.sq_sums[start : self.n_full]
+        # halves of chains are treated as separate chains
+        sums = torch.cat([sums[:n_half].sum(0), sums[n_half:].sum(0)])
+        sq_sums = torch.cat([sq_sums[:n_half].sum(0), sq_sums[n_half:].sum(0)])
+        n = n_half * self.batch_size
+
+        means = sums / n
+        within = ((sq_sums - n * means ** 2) / (n - 1)).mean(0)
+        between = n * means.var(0)
+        var_plus = (n - 1) / n * within + between / n
+        rhat = (var_plus / within.clamp(min=1e-12)).sqrt()
+        return rhat.max().item()
+
+    def ess(self) -> float:
+        """Batch means ESS summed over chains, minimum over dimensions"""
+        if self.n_full < 2:
+            return float("nan")
+        sums = self.sums[: self.n_full]
+        n = self.n_samples
+
+        means = sums.sum(0) / n
+        var = (self.sq_sums[: self.n_full].sum(0) - n * means ** 2) / (n - 1)
+        var_bm = self.batch_size * (sums / self.batch_size).var(0)
+        ess = (n * var / var_bm.clamp(min=1e-12)).clamp(max=n)
+        return ess.sum(0).min().item()
+
+
+class Autocorrelation:
+    """
+    Streaming autocorrelation of per-chain scalar traces for lags 1..max_lag,
+    averaged over chains, sums are kept on the device of the traces
+
+    Args:
+        max_lag - maximal lag
+    """
+
+    def __init__(self, max_lag: int = 10):
+        self.max_lag = max_lag
+        self.history: deque = deque(maxlen=max_lag)
+        self.cnt = 0
+        self.sum: Optional[torch.Tensor] = None
+        self.sq_sum: Optional[torch.Tensor] = None
+        self.lag_sums: Optional[torch.Tensor] = None
+        self.lag_cnts = np.zeros(max_lag)
+
+    @torch.no_grad()
+    def update(self, x: torch.Tensor):
+        """x - values of shape [n_chains] (or scalar)"""
+        x = torch.as_tensor(x).detach().double().reshape(-1)
+        if self.lag_sums is None:
+            self.sum = x.new_zeros(())
+            self.sq_sum = x.new_zeros(())
+            self.lag_sums = x.new_zeros(self.max_lag)
+        if self.history:
+            prev = torch.stack(list(reversed(self.history)))
+            self.lag_sums[: len(prev)] += (prev * x).mean(1)
+            self.lag_cnts[: len(prev)] += 1
+        self.history.append(x)
+        self.cnt += 1
+        self.sum += x.mean()
+        self.sq_sum += (x ** 2).mean()
+
+    def to(self, device: Union[str, int, torch.device]) -> "Autocorrelation":
+        self.history = deque([x.to(device) for x in self.history], self.max_lag)
+        if self.lag_sums is not None:
+            self.sum = self.sum.to(device)
+            self.sq_sum = self.sq_sum.to(device)
+            self.lag_sums = self.lag_sums.to(device)
+        return self
+
+    def values(self) -> np.ndarray:
+        if self.cnt < 2:
+            return np.full(self.max_lag, np.nan)
+        mean = self.sum.item() / self.cnt
+        var = self.sq_sum.item() / self.cnt - mean ** 2
+        with np.errstate(divide="ignore", invalid="ignore"):
+            cov = self.lag_sums.cpu().numpy() / self.lag_cnts - mean ** 2
+            return cov / var
+
+
+class OnlineDiagnostics:
+    """
+    Convergence diagnostics computed incrementally along sampling
+
+    Split-R-hat and batch means ESS are computed on latent chains,
+    autocorrelations on energies and on feature residual.
+
+    Args:
+        max_batches - maximal number of batches kept by BatchMeans
+        max_lag - maximal lag of autocorrelations
+    """
+
+    def __init__(self, max_batches: int = 64, max_lag: int = 10):
+        self.max_batches = max_batches
+        self.max_lag = max_lag
+        self.reset()
+
+    def reset(self):
+        self.latents = BatchMeans(self.max_batches)
+        self.energy = Autocorrelation(self.max_lag)
+        self.residual = Autocorrelation(self.max_lag)
+        self.start_time: Optional[float] = None
+
+    def update(
+        self,
+        z: torch.Tensor,
+        energy: Optional[torch.Tensor] = None,
+        residual: Optional[torch.Tensor] = None,
+    ):
+        if self.start_time is None:
+            self.start_time = time.perf_counter()
+        self.latents.update(z.reshape(len(z), -1))
+        if energy is not None:
+            self.energy.update(energy)
+        if residual is not None:
+            self.residual.update(residual)
+
+    def to(self, device: Union[str, int, torch.device]) -> "OnlineDiagnostics":
+        self.latents.to(device)
+        self.energy.to(device)
+        self.residual.to(device)
+        return self
+
+    def summary(self) -> Dict[str, float]:
+        elapsed = time.perf_counter() - (self.start_time or time.perf_counter())
+        ess = self.latents.ess()
+        return dict(
+            rhat=self.latents.split_rhat(),
+            ess=ess,
+            ess_per_sec=ess / elapsed if elapsed > 0 else float("nan"),
+            energy_autocorr=float(self.energy.values()[0]),
+            residual_autocorr=float(self.residual.values()[0]),
+        )
@@ -1,7 +1,9 @@
+import os
 import random
 import time
 from collections import Mapping
 from pathlib import Path
+from typing import Any, Callable, Dict, Union
 
 import numpy as np
 import torch
@@ -71,6 +73,71 @@ def random_seed(seed):
     g.manual_seed(seed)
 
 
+def get_rng_state() -> Dict[str, Any]:
+    return dict(
+        torch=torch.get_rng_state(),
+        cuda=torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+        numpy=np.random.get_state(),
+        random=random.getstate(),
+    )
+
+
+def set_rng_state(state: Dict[str, Any]):
+    torch.set_rng_state(state["torch"])
+    if state["cuda"] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(state["cuda"])
+    np.random.set_state(state["numpy"])
+    random.setstate(state["random"])
+
+
+def to_device(obj: Any, device: Union[str, int, torch.device]) -> Any:
+    """
+    Moves tensors in (nested) dicts, lists and tuples to device, as well as
+    objects with method "to" (e.g. preconditioners and step size adapters)
+    """
+    if isinstance(obj, torch.Tensor) or callable(getattr(obj, "to", None)):
+        return obj.to(device)
+    if isinstance(obj, dict):
+        return {key: to_device(value, device) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(to_device(value, device) for value in obj)
+    return obj
+
+
+def save_atomic(obj: Any, path: Union[str, Path]):
+    """
+    Saves object with torch.save to temporary file and moves it to path,
+    so path always holds either previous or new complete object
+    """
+    path = Path(path)
+    tmp_path = path.with_name(f".{path.name}.tmp")
+    with tmp_path.open("wb") as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+
+
+def load_uint8_cache(
+    path: Union[str, Path], build: Callable[[], np.ndarray]
+) -> np.ndarray:
+    """
+    Memory-maps uint8 array cached at path (.npy), the array is built and
+    atomically written on the first call
+    """
+    path = Path(path)
+    if not path.exists():
+        path.parent.mkdir(exist_ok=True, parents=True)
+        array = np.ascontiguousarray(build(), dtype=np.uint8)
+        tmp_path = path.with_name(f".{path.name}.tmp")
+        with tmp_path.open("wb") as f:
+            np.save(f, array)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    return np.load(path, mmap_mode="r")
+
+
 def seed_worker(worker_id):
     worker_seed = torch.initial_seed() % 2 ** 32
     np.random.seed(worker_seed)
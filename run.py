@@ -4,6 +4,7 @@ import logging
 import subprocess
 import sys
 from pathlib import Path
+from typing import Dict
 
 import numpy as np
 import ruamel.yaml as yaml
@@ -11,17 +12,21 @@ import torch
 import torchvision
 import wandb
 from tools.vizualization.plot_results import plot_res
-from torch.utils.data import DataLoader
 
-from maxent_gan.datasets.utils import get_dataset
+from maxent_gan.datasets.utils import get_dataloader, get_dataset
 from maxent_gan.distribution import Distribution, DistributionRegistry
 from maxent_gan.feature import BaseFeature, create_feature
 from maxent_gan.models.flow.real_nvp import RNVP  # noqa: F401
 from maxent_gan.models.flow.real_nvp_minimal import RealNVPProposal
 from maxent_gan.models.utils import GANWrapper
-from maxent_gan.sample import MaxEntSampler
+from maxent_gan.sample import MaxEntSampler, ShardedMaxEntSampler
 from maxent_gan.utils.callbacks import CallbackRegistry
-from maxent_gan.utils.general_utils import DotConfig, IgnoreLabelDataset, random_seed
+from maxent_gan.utils.general_utils import (
+    DotConfig,
+    IgnoreLabelDataset,
+    random_seed,
+    save_atomic,
+)
 from maxent_gan.utils.metrics.compute_fid_tf import calculate_fid_given_paths
 from maxent_gan.utils.metrics.inception_score import (
     MEAN_TRASFORM,
@@ -87,10 +92,41 @@ def define_sampler(
         **config.sample_params.params,
         callbacks=sampler_callbacks,
     )
+    n_workers = config.sample_params.get("n_workers", 1)
+    if n_workers > 1:
+        sampler = ShardedMaxEntSampler(
+            sampler, n_workers, gan=gan, seed=config.get("seed", None)
+        )
 
     return sampler
 
 
+def write_slice(
+    slices: Dict[int, np.memmap],
+    slice_id: int,
+    path: Path,
+    start_id: int,
+    batch: torch.Tensor,
+    config: DotConfig,
+):
+    """
+    Writes batch of samples into slice file of shape [total_n, ...],
+    slice file is created on the first write (reopened if run is resumed)
+    """
+    if slice_id not in slices:
+        if config.resume and path.exists():
+            slices[slice_id] = np.lib.format.open_memmap(path, mode="r+")
+        else:
+            slices[slice_id] = np.lib.format.open_memmap(
+                path,
+                mode="w+",
+                dtype=np.float32,
+                shape=(config.sample_params.total_n, *batch.shape[1:]),
+            )
+    batch = batch[: config.sample_params.total_n - start_id]
+    slices[slice_id][start_id : start_id + len(batch)] = batch.detach().numpy()
+
+
 def main(config: DotConfig, device: torch.device, group: str):
     suffix = f"_{config.suffix}" if config.suffix else ""
     dir_suffix = f"_{config.distribution.name}"
@@ -102,7 +138,7 @@ def main(config: DotConfig, device: torch.device, group: str):
         **config.gan_config.dataset.params,
     )
     dataset = dataset_info["dataset"]
-    dataloader = DataLoader(dataset, batch_size=config.data_batch_size)
+    dataloader = get_dataloader(dataset, batch_size=config.data_batch_size)
 
     # sample
     if config.sample_params.sample:
@@ -145,13 +181,20 @@ def main(config: DotConfig, device: torch.device, group: str):
 
         if config.seed is not None:
             random_seed(config.seed)
-        total_sample_z = []
-        total_sample_x = []
         total_labels = []
         weights = []
 
         labels = None
-        if config.resume:
+        checkpoint_path = Path(save_dir, "checkpoint.pt")
+        checkpoint = None
+        if config.resume and checkpoint_path.exists():
+            # RNG states have to stay on CPU, sampler moves its state to device
+            checkpoint = torch.load(checkpoint_path, map_location="cpu")
+            start_latents = checkpoint["start_latents"]
+            labels = checkpoint["labels"]
+            weights = [w.to(device) for w in checkpoint["weights"]]
+            start_step_id = 0
+        elif config.resume:
             latents_dir = Path(save_dir, "latents")
             lat_paths = sorted(
                 latents_dir.glob("*.npy"), key=lambda x: int(x.stem.split("_")[-1])
@@ -179,6 +222,19 @@ def main(config: DotConfig, device: torch.device, group: str):
             )
 
         sampler = define_sampler(config, gan, ref_dist, feature, save_dir)
+        # sharded sampler keeps its state in worker processes
+        checkpoint_every = (
+            config.sample_params.get("checkpoint_every")
+            if isinstance(sampler, MaxEntSampler)
+            else None
+        )
+
+        imgs_dir = Path(save_dir, "images")
+        imgs_dir.mkdir(exist_ok=True)
+        latents_dir = Path(save_dir, "latents")
+        latents_dir.mkdir(exist_ok=True)
+        z_slices = dict()
+        x_slices = dict()
 
         for i, start, label in zip(
             range(0, config.sample_params.total_n, config.sample_params.batch_size),
@@ -186,6 +242,10 @@ def main(config: DotConfig, device: torch.device, group: str):
             torch.split(labels, config.sample_params.batch_size),
         ):
             print(i)
+            if checkpoint is not None and i < checkpoint["batch"]:
+                # batch is already sampled
+                total_labels.append(label.cpu())
+                continue
 
             if i > 0:
                 feature.reset()
@@ -206,53 +266,84 @@ def main(config: DotConfig, device: torch.device, group: str):
                     opt, lambda it: int(it < config.flow.train_iters)
                 )
 
+            start_it = 0
+            first_slice_id = 0
+            if checkpoint is not None and checkpoint["sampler"] is not None:
+                sampler.load_state_dict(checkpoint["sampler"])
+                if config.get("flow", None):
+                    gan.gen.prior.load_state_dict(checkpoint["flow"]["prior"])
+                    gan.gen.prior.optim.load_state_dict(checkpoint["flow"]["optim"])
+                    gan.gen.prior.scheduler.load_state_dict(
+                        checkpoint["flow"]["scheduler"]
+                    )
+                start = checkpoint["z"]
+                start_it = checkpoint["it"]
+                first_slice_id = checkpoint["slice_id"] + 1
+            checkpoint = None
+
             start = start.to(device)
             label = label.to(device)
             gan.set_label(label)
 
-            zs, xs, _, _ = sampler(start)
+            # slices are written to disk as soon as they are produced
+            for slice_id, (it, z, x) in enumerate(
+                sampler.stream(start, start_it=start_it), start=first_slice_id
+            ):
+                step = (slice_id + start_step_id) * config.sample_params.save_every
+                name = f"{step}.npy"
+                write_slice(z_slices, slice_id, Path(latents_dir, name), i, z, config)
+                if x is not None:
+                    write_slice(x_slices, slice_id, Path(imgs_dir, name), i, x, config)
+                if checkpoint_every and slice_id % checkpoint_every == 0:
+                    for slice_file in list(z_slices.values()) + list(x_slices.values()):
+                        slice_file.flush()
+                    flow_state = None
+                    if config.get("flow", None):
+                        flow_state = dict(
+                            prior=gan.gen.prior.state_dict(),
+                            optim=gan.gen.prior.optim.state_dict(),
+                            scheduler=gan.gen.prior.scheduler.state_dict(),
+                        )
+                    sampler.save_checkpoint(
+                        checkpoint_path,
+                        z,
+                        it,
+                        batch=i,
+                        slice_id=slice_id,
+                        start_latents=start_latents,
+                        labels=labels,
+                        weights=weights,
+                        flow=flow_state,
+                    )
             sampler.reset()
-            gan.gen.input = gan.gen.output = gan.dis.input = gan.dis.output = None
+            gan.gen.clear()
+            gan.dis.clear()
 
-            zs = torch.stack(zs, 0).cpu()
-            xs = torch.stack(xs, 0).cpu()
-            print(zs.shape)
-            total_sample_z.append(zs)
-            total_sample_x.append(xs)
             total_labels.append(label.cpu())
             if len(feature.weight) > 0:
                 weights.append(torch.cat(feature.weight, dim=0).detach())
+            if checkpoint_every:
+                for slice_file in list(z_slices.values()) + list(x_slices.values()):
+                    slice_file.flush()
+                save_atomic(
+                    dict(
+                        sampler=None,
+                        batch=i + 1,
+                        start_latents=start_latents,
+                        labels=labels,
+                        weights=weights,
+                    ),
+                    checkpoint_path,
+                )
+
+        for slice_file in list(z_slices.values()) + list(x_slices.values()):
+            slice_file.flush()
+        del z_slices, x_slices
 
-        total_sample_z = torch.cat(total_sample_z, 1)[
-            :, : config.sample_params.total_n
-        ]  # (number_of_steps / every) x total_n x latent_dim
-        total_sample_x = torch.cat(total_sample_x, 1)[
-            :, : config.sample_params.total_n
-        ]  # (number_of_steps / every) x total_n x img_size x img_size
         total_labels = torch.cat(total_labels, 0)[: config.sample_params.total_n]
         if len(feature.weight) > 0:
             weights = torch.stack(weights, 0)
 
-        imgs_dir = Path(save_dir, "images")
-        imgs_dir.mkdir(exist_ok=True)
-        latents_dir = Path(save_dir, "latents")
-        latents_dir.mkdir(exist_ok=True)
-        for slice_id in range(total_sample_x.shape[0]):
-            np.save(
-                Path(
-                    imgs_dir,
-                    f"{(slice_id + start_step_id) * config.sample_params.save_every}.npy",
-                ),
-                total_sample_x[slice_id].cpu().numpy(),
-            )
-            np.save(
-                Path(
-                    latents_dir,
-                    f"{(slice_id + start_step_id) * config.sample_params.save_every}.npy",
-                ),
-                total_sample_z[slice_id].cpu().numpy(),
-            )
-
         np.save(
             Path(
                 save_dir,
@@ -0,0 +1,30 @@
+import pytest
+
+
+torch = pytest.importorskip("torch")
+
+from torch.distributions import MultivariateNormal  # noqa: E402
+
+from maxent_gan.mcmc import ChainBuffer, ula  # noqa: E402
+
+
+@pytest.mark.parametrize("n_samples, thinning", [(6, 2), (5, 2), (7, 3), (1, 4)])
+def test_chain_buffer_thinning(n_samples, thinning):
+    chains = ChainBuffer(n_samples, 2, thinning=thinning)
+    for step_id in range(n_samples + 2):
+        chains.push(step_id, torch.full((3, 2), float(step_id)))
+
+    # states are kept from the first step after burn-in, so partial
+    # thinning windows at the end are kept too
+    n_kept = -(-n_samples // thinning)
+    assert chains.data.shape == (n_kept, 3, 2)
+    assert chains.data[:, 0, 0].tolist() == list(range(2, n_samples + 2, thinning))
+
+
+def test_kernel_thinning():
+    target = MultivariateNormal(torch.zeros(2), torch.eye(2))
+    start = torch.randn(4, 2)
+    chains, _ = ula(
+        start, target, target, 5, 1, lambda z: z, step_size=0.01, thinning=2
+    )
+    assert chains.shape == (3, 4, 2)
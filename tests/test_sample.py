@@ -0,0 +1,108 @@
+import pytest
+
+
+torch = pytest.importorskip("torch")
+
+from torch import nn  # noqa: E402
+from torch.distributions import MultivariateNormal  # noqa: E402
+
+from maxent_gan.distribution import PriorTarget  # noqa: E402
+from maxent_gan.feature.feature import DumbFeature  # noqa: E402
+from maxent_gan.sample import MaxEntSampler, ShardedMaxEntSampler  # noqa: E402
+from maxent_gan.utils.general_utils import to_device  # noqa: E402
+
+
+class Generator(nn.Linear):
+    def __init__(self, z_dim: int = 2):
+        super().__init__(z_dim, 3)
+        self.prior = MultivariateNormal(torch.zeros(z_dim), torch.eye(z_dim))
+        self.prior.project = lambda z: z
+
+    def inverse_transform(self, x: torch.Tensor) -> torch.Tensor:
+        return x
+
+
+def create_sampler(sampling: str = "ula", **mcmc_args) -> MaxEntSampler:
+    gen = Generator()
+    feature = DumbFeature(inverse_transform=gen.inverse_transform, device="cpu")
+    return MaxEntSampler(
+        gen,
+        PriorTarget(gen),
+        feature,
+        n_steps=4,
+        sampling=sampling,
+        mcmc_args=dict(step_size=0.01, **mcmc_args),
+        verbose=False,
+        collect_imgs=False,
+    )
+
+
+def test_sharded_stream():
+    sampler = ShardedMaxEntSampler(create_sampler(), n_workers=2, seed=0)
+    z = torch.randn(6, 2)
+
+    its = []
+    for it, z_it, x_it in sampler.stream(z):
+        its.append(it)
+        assert z_it.shape == z.shape
+        assert x_it is None
+    assert its == [0, 1, 2, 3, 4]
+
+    # resumed workers continue from the merged state of the wrapped sampler
+    its = [it for it, _, _ in sampler.stream(z, start_it=2)]
+    assert its == [3, 4]
+
+
+def test_sharded_merge_dual_averaging():
+    sampler = ShardedMaxEntSampler(
+        create_sampler("mala", target_acceptance=0.57, adapt="dual_averaging"),
+        n_workers=2,
+    )
+    z = torch.randn(5, 2)
+    list(sampler.stream(z))
+
+    # scalar adapted step size is averaged, per-chain state is concatenated
+    assert sampler.mcmc_args["step_size"].ndim == 0
+    assert sampler.meta["logp"].shape == (5,)
+
+
+def test_sharded_merge_replica_exchange():
+    sampler = ShardedMaxEntSampler(
+        create_sampler("replica_exchange", n_temperatures=3), n_workers=2
+    )
+    z = torch.randn(5, 2)
+    list(sampler.stream(z))
+
+    assert sampler.meta["replicas"].shape == (3, 5, 2)
+    assert sampler.meta["betas"].shape == (3,)
+    assert sampler.meta["swap_rejection"].shape == (2,)
+
+
+def test_resume_adapted_state(tmp_path):
+    sampler = create_sampler(
+        "pmala",
+        rank=1,
+        n_warmup=2,
+        target_acceptance=0.57,
+        per_chain_step_size=True,
+    )
+    z = torch.randn(6, 2)
+    *_, (it, z_it, _) = sampler.stream(z, n_steps=3)
+    sampler.save_checkpoint(tmp_path / "state.pt", z_it, it)
+
+    state = torch.load(tmp_path / "state.pt", map_location="cpu")
+    resumed = create_sampler(
+        "pmala",
+        rank=1,
+        n_warmup=2,
+        target_acceptance=0.57,
+        per_chain_step_size=True,
+    )
+    resumed.load_state_dict(state["sampler"])
+    its = [it for it, _, _ in resumed.stream(state["z"], start_it=state["it"])]
+    assert its == [4]
+
+    # stateful helpers in meta are moved along with tensors
+    meta = to_device(resumed.meta, "meta")
+    assert meta["preconditioner"].diag.is_meta
+    assert meta["step_size_adapter"].log_step_size.is_meta
@@ -10,9 +10,8 @@ import numpy as np
 import ruamel.yaml as yaml
 import torch
 from torch.optim import Adam  # noqa: F401
-from torch.utils.data import DataLoader
 
-from maxent_gan.datasets.utils import TrainGANDataset, get_dataset
+from maxent_gan.datasets.utils import TrainGANDataset, get_dataloader, get_dataset
 from maxent_gan.distribution import DistributionRegistry
 from maxent_gan.feature.utils import create_feature
 from maxent_gan.sample import MaxEntSampler
@@ -139,7 +138,7 @@ def main(config: DotConfig, device: torch.device, group: str):
     )
     g = torch.Generator()
     g.manual_seed(config.seed)
-    dataloader = DataLoader(
+    dataloader = get_dataloader(
         dataset,
         batch_size=config.train_batch_size,
         shuffle=True,
@@ -208,7 +207,7 @@ def main(config: DotConfig, device: torch.device, group: str):
     ref_dist = DistributionRegistry.create(
         config.sample_params.distribution.name, gan=gan
     )
-    feature_dataloader = DataLoader(dataset, batch_size=config.data_batch_size)
+    feature_dataloader = get_dataloader(dataset, batch_size=config.data_batch_size)
     feature = create_feature(
         config, gan, feature_dataloader, dataset_stuff, save_dir, device
     )